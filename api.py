@@ -0,0 +1,127 @@
+import bottle
+import json
+import typing
+import webview
+import wvruntime
+
+import jobs
+import stats
+import tracing
+
+__all__ = [
+    'exposeMsgpackJob',
+    'initJobApi',
+    'initTracing',
+]
+
+# 应用自身的HTTP API：任务、统计和追踪，通过wvruntime提供的扩展点注册，wvruntime本身不依赖这些模块
+
+class MsgpackApiHooks(wvruntime.MsgpackApiHooks):
+    def request(self, fn: str) -> typing.ContextManager:
+        return tracing.span(f'/api/{fn}', 'http')
+
+    def phase(self, fn: str, phase: str) -> typing.ContextManager:
+        return stats.timer(phase, fn=fn)
+
+    def finished(self, fn: str, success: bool):
+        stats.count('requests_total', fn=fn, status='ok' if success else 'error')
+
+wvruntime.msgpackApiHooks = MsgpackApiHooks()
+
+@wvruntime.app.post('/api/trace')
+def _():
+    '''
+    接收前端记录的_callMsgpackApi的耗时（仅在启用tracing时）
+    '''
+    if not tracing.enabled:
+        return bottle.HTTPError(404)
+    for e in bottle.request.json:
+        tracing.complete(e['name'], e['ts'], e['dur'], 'frontend', pid=0, tid=0, processName='WebView')
+    return bottle.HTTPResponse(status=204)
+
+@wvruntime.app.get('/api/stats')
+def _():
+    '''
+    各阶段的耗时和数据量统计
+    默认返回JSON，使用?format=prometheus返回Prometheus的文本格式
+    '''
+    if bottle.request.query.get('format') == 'prometheus':
+        return bottle.HTTPResponse(stats.prometheus(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+    return bottle.HTTPResponse(json.dumps(stats.snapshot()), headers={'Content-Type': 'application/json'})
+
+jobApimap: dict[str, typing.Callable] = {}
+
+def exposeMsgpackJob(window: webview.Window, name: str):
+    '''
+    在JS环境中导出可以作为任务异步执行的Python环境的函数
+    使用submitJob(name, ...args)提交后立即返回任务ID，之后通过jobStatus/awaitJob/jobResult/cancelJob查询或取消
+    函数需要接受cancelEvent和job两个关键字参数
+
+    Parameters
+    ----------
+    window : webview.Window
+        需要导出函数的窗口
+    name : str
+        提交任务时使用的函数名称
+    '''
+    def decorator(f: typing.Callable):
+        jobApimap[name] = f
+        return f
+    return decorator
+
+def initJobApi(window: webview.Window):
+    '''
+    导出任务相关的msgpack API，需要先执行wvruntime.initMsgpackApi
+    '''
+    @wvruntime.exposeMsgpack(window, 'submitJob')
+    def _(fn: str, *args):
+        if (func := jobApimap.get(fn, None)) is None:
+            raise RuntimeError(f'Unknown job function: {fn}')
+        return jobs.submit(fn, func, *args).toDict()
+
+    @wvruntime.exposeMsgpack(window, 'jobStatus')
+    def _(id: str):
+        return jobs.get(id).toDict()
+
+    @wvruntime.exposeMsgpack(window, 'awaitJob')
+    def _(id: str, timeout: float = 30):
+        '''
+        长轮询：任务结束或超时后返回任务状态
+        '''
+        return jobs.wait(id, timeout).toDict()
+
+    @wvruntime.exposeMsgpack(window, 'jobResult')
+    def _(id: str):
+        job = jobs.get(id)
+        if job.status == 'error':
+            raise RuntimeError(f'{job.error[0]}: {job.error[1]}')
+        if job.status != 'done':
+            raise RuntimeError(f'Job is {job.status}: {id}')
+        return job.result
+
+    @wvruntime.exposeMsgpack(window, 'cancelJob')
+    def _(id: str):
+        return jobs.cancel(id).toDict()
+
+def initTracing(window: webview.Window):
+    '''
+    启用tracing时记录前端调用msgpack API的耗时，需要先执行wvruntime.initMsgpackApi
+    '''
+    if tracing.enabled:
+        window.evaluate_js('''
+            (() => {
+                const callMsgpackApi = window.pywebview._callMsgpackApi;
+                const now = () => (performance.timeOrigin + performance.now()) * 1000;
+                window.pywebview._callMsgpackApi = (fn, ...args) => {
+                    const ts = now();
+                    const report = () => fetch('/api/trace', {
+                        method: 'POST',
+                        headers: {
+                            'Content-Type': 'application/json',
+                        },
+                        body: JSON.stringify([{ name: `_callMsgpackApi(${fn})`, ts, dur: now() - ts }]),
+                    });
+                    return callMsgpackApi(fn, ...args).finally(report);
+                };
+            })();
+        ''')
@@ -0,0 +1,210 @@
+import argparse
+import datetime
+import itertools
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import typing
+
+import image_cli
+import runner
+import stats
+
+def product(**values: tuple[int | float | bool, ...]) -> list[dict[str, int | float | bool]]:
+    return [dict(zip(values, x)) for x in itertools.product(*values.values())]
+
+# effort和README中的压缩时间表格对应，Squoosh UI中AVIF的Effort = 10 - speed
+# quality取默认值和其上下各一档
+defaultGrid: dict[str, list[dict[str, int | float | bool]]] = {
+    'avif': product(speed=(6, 3), quality=(30, 50, 70)),
+    'jxl': product(effort=(5, 7), quality=(60, 75, 90)),
+    'jpegli': product(quality=(60, 75, 90)),
+    'mozJPEG': product(quality=(60, 75, 90)),
+    'oxiPNG': product(level=(2, 4)),
+    'pngquant': product(quality=(50, 75, 100)),
+    'webP': product(method=(4, 6), quality=(60, 75, 90)),
+}
+
+# Two-sided 95% critical values of Student's t-distribution for df = 1 ~ 30
+tTable = (
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+)
+
+def summarize(values: list[float]) -> dict[str, float]:
+    '''
+    Mean, standard deviation and half width of the 95% confidence interval of the mean.
+    '''
+    n = len(values)
+    mean = statistics.fmean(values)
+    stdev = statistics.stdev(values) if n > 1 else 0.
+    t = tTable[n - 2] if 1 < n <= len(tTable) + 1 else 1.96
+    return {
+        'mean': mean,
+        'stdev': stdev,
+        'ci95': t * stdev / math.sqrt(n) if n > 1 else 0.,
+        'min': min(values),
+        'max': max(values),
+    }
+
+def benchmark(file: str, encoderType: str, overrides: dict[str, typing.Any], repeat: int, warmup: int) -> dict[str, typing.Any]:
+    encoderOptionsClass = image_cli.encoderOptionsClassMapping[encoderType]
+    options = {**encoderOptionsClass.defaultOptions, **overrides}
+    tempOutput = tempfile.mktemp()
+    command = encoderOptionsClass(**options).buildCommand(file, tempOutput)
+    runs: list[runner.RunResult] = []
+    sizes: list[int] = []
+    try:
+        for i in range(warmup + repeat):
+            r = runner.run(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
+            )
+            if i >= warmup:
+                runs.append(r)
+                sizes.append(os.path.getsize(tempOutput))
+            os.remove(tempOutput)
+    finally:
+        if os.path.exists(tempOutput):
+            os.remove(tempOutput)
+    return {
+        'file': os.path.basename(file),
+        'inputSize': os.path.getsize(file),
+        'encoder': encoderType,
+        'overrides': overrides,
+        'settings': stats.settingsLabel(options),
+        'runs': len(runs),
+        'wallTime': summarize([r.wallTime for r in runs]),
+        'cpuTime': summarize([r.userTime + r.systemTime for r in runs]),
+        'peakMemory': max((r.peakMemory for r in runs if r.peakMemory is not None), default=None),
+        'outputSize': sizes[-1],
+        'outputSizeStable': len(set(sizes)) == 1,
+    }
+
+def caseKey(result: dict[str, typing.Any]) -> tuple[str, str, str]:
+    return result['file'], result['encoder'], result['settings']
+
+def compare(results: list[dict[str, typing.Any]], baseline: list[dict[str, typing.Any]], timeTolerance: float, sizeTolerance: float) -> list[dict[str, typing.Any]]:
+    '''
+    Compare results against a baseline.
+    A case regresses if its mean wall time grows by more than both the combined 95% CI and `timeTolerance`,
+    or its output size grows by more than `sizeTolerance`.
+    '''
+    baselineMap = {caseKey(x): x for x in baseline}
+    report = []
+    for r in results:
+        if (b := baselineMap.get(caseKey(r))) is None:
+            continue
+        delta = r['wallTime']['mean'] - b['wallTime']['mean']
+        threshold = max(r['wallTime']['ci95'] + b['wallTime']['ci95'], b['wallTime']['mean'] * timeTolerance)
+        sizeRatio = r['outputSize'] / b['outputSize'] if b['outputSize'] else 1.
+        if delta > threshold:
+            timeStatus = 'regression'
+        elif -delta > threshold:
+            timeStatus = 'improvement'
+        else:
+            timeStatus = 'unchanged'
+        report.append({
+            'file': r['file'],
+            'encoder': r['encoder'],
+            'overrides': r['overrides'],
+            'wallTime': (b['wallTime']['mean'], r['wallTime']['mean']),
+            'timeRatio': r['wallTime']['mean'] / b['wallTime']['mean'],
+            'timeStatus': timeStatus,
+            'outputSize': (b['outputSize'], r['outputSize']),
+            'sizeRatio': sizeRatio,
+            'sizeStatus': 'regression' if sizeRatio > 1 + sizeTolerance else 'improvement' if sizeRatio < 1 - sizeTolerance else 'unchanged',
+        })
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the native encoders in the bin folder.')
+    parser.add_argument('files', nargs='+', help='PNG images used as the corpus')
+    parser.add_argument('-e', '--encoder', action='append', choices=tuple(image_cli.encoderOptionsClassMapping), help='encoders to run (default: all available)')
+    parser.add_argument('-g', '--grid', help='JSON file mapping encoder type to a list of option overrides (default: README effort levels x three quality points)')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='timed runs per case (default: %(default)s)')
+    parser.add_argument('-w', '--warmup', type=int, default=1, help='untimed runs per case (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('-b', '--baseline', help='JSON written by a previous run to compare against')
+    parser.add_argument('--time-tolerance', type=float, default=.05, help='relative wall time change ignored in comparison (default: %(default)s)')
+    parser.add_argument('--size-tolerance', type=float, default=.01, help='relative output size change ignored in comparison (default: %(default)s)')
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    if args.warmup < 0:
+        parser.error('--warmup must not be negative')
+
+    if args.grid:
+        with open(args.grid, 'r', encoding='utf-8') as f:
+            grid = json.load(f)
+    else:
+        grid = defaultGrid
+    codecs = image_cli.checkCodec()
+    encoders = args.encoder or [k for k in grid if codecs.get(k)]
+
+    results = []
+    for file in args.files:
+        for encoderType in encoders:
+            if not codecs.get(encoderType):
+                print(f'Skipped {encoderType}: not available in {image_cli.binDir}', file=sys.stderr)
+                continue
+            for overrides in grid.get(encoderType, [{}]):
+                r = benchmark(file, encoderType, overrides, args.repeat, args.warmup)
+                results.append(r)
+                print(
+                    r['file'],
+                    r['encoder'],
+                    json.dumps(overrides),
+                    f'{r['wallTime']['mean'] * 1000:.2f}±{r['wallTime']['ci95'] * 1000:.2f}ms',
+                    f'cpu {r['cpuTime']['mean'] * 1000:.2f}ms',
+                    f'{r['peakMemory'] / 1048576:.1f}MiB' if r['peakMemory'] is not None else '-',
+                    f'{r['outputSize']}B',
+                    sep='\t',
+                )
+
+    output = {
+        'meta': {
+            'time': datetime.datetime.now().isoformat(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpuCount': os.cpu_count(),
+            'codecs': codecs,
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        report = compare(results, baseline['results'], args.time_tolerance, args.size_tolerance)
+        regressed = False
+        for x in report:
+            if 'regression' in {x['timeStatus'], x['sizeStatus']}:
+                regressed = True
+            print(
+                x['file'],
+                x['encoder'],
+                json.dumps(x['overrides']),
+                f'time {x['timeRatio']:.3f}x {x['timeStatus']}',
+                f'size {x['sizeRatio']:.3f}x {x['sizeStatus']}',
+                sep='\t',
+            )
+        if regressed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
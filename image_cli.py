@@ -1,22 +1,147 @@
 import functools
 import subprocess
 import os
+import re
+import statistics
+import struct
+import tempfile
+import threading
 import typing
 import wvruntime
 from concurrent.futures import ThreadPoolExecutor
 
+import runner
+import scheduler
+
 binDir = os.path.join(wvruntime.executablePath, 'bin')
 
 class ImageData(typing.TypedDict):
     width: int
     height: int
     data: bytes
+    # Handle of an image in `imagestore` or key of a cached result of `preprocess.preprocess`,
+    # the other fields can be omitted when passing it back
+    handle: typing.NotRequired[str]
+
+class Rect(typing.TypedDict):
+    x: int
+    y: int
+    width: int
+    height: int
+
+class EncoderStage(typing.TypedDict):
+    type: str
+    options: dict[str, int | float | bool]
+    # Overrides `AbstractEncoderOptions.limits`
+    limits: typing.NotRequired[runner.Limits]
 
 class EncoderState(typing.TypedDict):
     type: str
     options: dict[str, int | float | bool]
+    # Encoders run after this one, each reading the output of the previous one
+    pipeline: typing.NotRequired[list[EncoderStage]]
+    # Seconds. If set, the effort option is chosen by `predict.autoEffort` to finish within it
+    deadline: typing.NotRequired[float]
+    # Overrides `AbstractEncoderOptions.limits` of the first encoder
+    limits: typing.NotRequired[runner.Limits]
+
+def cropImage(image: ImageData, rect: Rect, align: int = 1) -> tuple[ImageData, Rect]:
+    '''
+    Crop an RGBA image, expanding the rectangle outwards to multiples of align and clamping it to the image.
+    Returns the cropped image and the rectangle actually used.
+    '''
+    x0 = max(rect['x'] // align * align, 0)
+    y0 = max(rect['y'] // align * align, 0)
+    x1 = min(-(-(rect['x'] + rect['width']) // align) * align, image['width'])
+    y1 = min(-(-(rect['y'] + rect['height']) // align) * align, image['height'])
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f'Empty crop: {rect}')
+    data = memoryview(image['data'])
+    stride = image['width'] * 4
+    return {
+        'width': x1 - x0,
+        'height': y1 - y0,
+        'data': b''.join(data[y * stride + x0 * 4:y * stride + x1 * 4] for y in range(y0, y1)),
+    }, {
+        'x': x0,
+        'y': y0,
+        'width': x1 - x0,
+        'height': y1 - y0,
+    }
+
+def exifOrientation(exif: bytes) -> int:
+    '''
+    Read the Orientation tag from the IFD0 of an EXIF block (the APP1 payload after `Exif\\0\\0`). Returns 1 if absent.
+    '''
+    if len(exif) < 8 or exif[:2] not in (b'II', b'MM'):
+        return 1
+    order = '<' if exif[:2] == b'II' else '>'
+    offset = struct.unpack(order + 'I', exif[4:8])[0]
+    if offset + 2 > len(exif):
+        return 1
+    count = struct.unpack(order + 'H', exif[offset:offset + 2])[0]
+    for i in range(offset + 2, min(offset + 2 + count * 12, len(exif) - 11), 12):
+        tag, type, _ = struct.unpack(order + 'HHI', exif[i:i + 8])
+        # SHORT，值保存在偏移量字段的前两个字节
+        if tag == 0x0112 and type == 3:
+            return struct.unpack(order + 'H', exif[i + 8:i + 10])[0]
+    return 1
+
+def probeImage(file: str) -> tuple[str, int, int, int] | None:
+    '''
+    Read the format, width, height and EXIF orientation (1 ~ 8, only read from JPEG, 1 for the others)
+    from the header of a PNG, JPEG or WebP file without decoding it.
+    Width and height are as stored, before the orientation is applied.
+    Returns None for other formats or broken files.
+    '''
+    with open(file, 'rb') as f:
+        header = f.read(30)
+        if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+            return 'png', *struct.unpack('>II', header[16:24]), 1
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            match header[12:16]:
+                case b'VP8 ':
+                    w, h = struct.unpack('<HH', header[26:30])
+                    return 'webp', w & 0x3fff, h & 0x3fff, 1
+                case b'VP8L':
+                    x = int.from_bytes(header[21:25], 'little')
+                    return 'webp', (x & 0x3fff) + 1, (x >> 14 & 0x3fff) + 1, 1
+                case b'VP8X':
+                    return 'webp', int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1, 1
+            return None
+        if header[:2] != b'\xff\xd8':
+            return None
+        # 依次跳过JPEG的各个段，直到SOF，途中读取APP1中EXIF的方向
+        f.seek(2)
+        orientation = 1
+        while len(marker := f.read(4)) == 4 and marker[0] == 0xff:
+            length = int.from_bytes(marker[2:4], 'big')
+            if marker[1] in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf):
+                h, w = struct.unpack('>HH', f.read(5)[1:5])
+                return 'jpeg', w, h, orientation
+            if marker[1] == 0xe1:
+                if (data := f.read(length - 2))[:6] == b'Exif\0\0':
+                    orientation = exifOrientation(data[6:])
+                continue
+            f.seek(length - 2, os.SEEK_CUR)
+        return None
 
 class AbstractEncoderOptions:
+    # Same as the defaults in Squoosh's encoder UI
+    defaultOptions: dict[str, int | float | bool]
+    # The option trading speed for compression and its values from the fastest to the slowest
+    effortOption: str | None = None
+    effortLevels: tuple[int, ...] = ()
+    # Other options that change encoding time a lot, such as switching to lossless mode
+    costOptions: tuple[str, ...] = ()
+    # Cropped previews are aligned to this many pixels, e.g. the JPEG MCU or the AV1 superblock
+    blockSize: int = 1
+    # File formats accepted as input and written as output
+    inputFormats: tuple[str, ...] = ('png',)
+    outputFormat: str
+    # Resource limits of the CLI, the watchdog kills encodes running longer than wallTime
+    limits: runner.Limits = {'wallTime': 600.}
+
     def __init__(self, **kwargs) -> None:
         for k, v in kwargs.items():
             setattr(self, k, v)
@@ -28,6 +153,14 @@ class AbstractEncoderOptions:
     def buildCommand(self, inputFile: str, outputFile: str) -> list[str]:
         raise NotImplementedError()
 
+    def parseProgress(self, line: str) -> dict[str, typing.Any] | None:
+        '''
+        Extract progress from a line of the verbose output written to stderr.
+        Returns a dict with `stage`, optionally `progress` in [0, 1] and partial stats,
+        or None if the line carries nothing useful.
+        '''
+        return None
+
 class MozJPEGEncoderOptions(AbstractEncoderOptions):
     # https://github.com/GoogleChromeLabs/squoosh/blob/dev/codecs/mozjpeg/enc/mozjpeg_enc.cpp
     # https://github.com/mozilla/mozjpeg/blob/master/cjpeg.c
@@ -47,6 +180,26 @@ class MozJPEGEncoderOptions(AbstractEncoderOptions):
     chroma_subsample: int
     separate_chroma_quality: bool
     chroma_quality: int
+    blockSize = 16
+    outputFormat = 'jpeg'
+    defaultOptions = {
+        'quality': 75,
+        'baseline': False,
+        'arithmetic': False,
+        'progressive': True,
+        'optimize_coding': True,
+        'smoothing': 0,
+        'color_space': 3,
+        'quant_table': 3,
+        'trellis_multipass': False,
+        'trellis_opt_zero': False,
+        'trellis_opt_table': False,
+        'trellis_loops': 1,
+        'auto_subsample': True,
+        'chroma_subsample': 2,
+        'separate_chroma_quality': False,
+        'chroma_quality': 75,
+    }
 
     @staticmethod
     def checkInfo() -> str | None:
@@ -56,10 +209,10 @@ class MozJPEGEncoderOptions(AbstractEncoderOptions):
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.PIPE,
                 text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
             ).stderr.strip()
             return r if 'mozjpeg' in r else None
-        except FileNotFoundError:
+        except OSError:
             return None
 
     def buildCommand(self, inputFile: str, outputFile: str) -> list[str]:
@@ -114,6 +267,24 @@ class AVIFEncoderOptions(AbstractEncoderOptions):
     tune: int
     denoiseLevel: int
     enableSharpYUV: bool
+    effortOption = 'speed'
+    effortLevels = tuple(range(10, -1, -1))
+    blockSize = 64
+    inputFormats = ('png', 'jpeg')
+    outputFormat = 'avif'
+    defaultOptions = {
+        'quality': 50,
+        'qualityAlpha': -1,
+        'tileRowsLog2': 0,
+        'tileColsLog2': 0,
+        'speed': 6,
+        'subsample': 1,
+        'chromaDeltaQ': False,
+        'sharpness': 0,
+        'tune': 0,
+        'denoiseLevel': 0,
+        'enableSharpYUV': False,
+    }
 
     @staticmethod
     def checkInfo() -> str | None:
@@ -121,9 +292,9 @@ class AVIFEncoderOptions(AbstractEncoderOptions):
             return subprocess.check_output(
                 (os.path.join(binDir, 'avifenc'), '--version'),
                 text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
             ).strip()
-        except FileNotFoundError:
+        except OSError:
             return None
 
     def buildCommand(self, inputFile: str, outputFile: str) -> list[str]:
@@ -162,6 +333,19 @@ class AVIFEncoderOptions(AbstractEncoderOptions):
         args.append(outputFile)
         return args
 
+    def parseProgress(self, line: str) -> dict[str, typing.Any] | None:
+        if line.startswith('Successfully loaded'):
+            return {'stage': 'loaded', 'progress': .05}
+        if line.startswith('Encoding with codec'):
+            return {'stage': 'encoding', 'progress': .1}
+        if line.startswith('Encoded successfully'):
+            return {'stage': 'encoded', 'progress': .95}
+        if m := re.search(r'(Color|Alpha) (?:AV1 )?total size: (\d+) bytes', line):
+            return {'stage': 'encoded', 'progress': .95, f'{m.group(1).lower()}Size': int(m.group(2))}
+        if line.startswith('Wrote AVIF'):
+            return {'stage': 'written', 'progress': 1}
+        return None
+
 class JXLEncoderOptions(AbstractEncoderOptions):
     # https://github.com/GoogleChromeLabs/squoosh/blob/dev/codecs/jxl/enc/jxl_enc.cpp
     # https://github.com/libjxl/libjxl/blob/master/tools/cjxl_main.cc
@@ -173,6 +357,25 @@ class JXLEncoderOptions(AbstractEncoderOptions):
     decodingSpeedTier: int
     photonNoiseIso: float
     lossyModular: bool
+    # Not in Squoosh. Losslessly recompress JPEG input so that the original JPEG can be reconstructed
+    losslessJpeg = False
+    effortOption = 'effort'
+    effortLevels = tuple(range(1, 10))
+    costOptions = ('lossyModular', 'lossyPalette', 'losslessJpeg')
+    # Group size
+    blockSize = 256
+    inputFormats = ('png', 'jpeg')
+    outputFormat = 'jxl'
+    defaultOptions = {
+        'effort': 7,
+        'quality': 75,
+        'progressive': False,
+        'epf': -1,
+        'lossyPalette': False,
+        'decodingSpeedTier': 0,
+        'photonNoiseIso': 0,
+        'lossyModular': False,
+    }
 
     @staticmethod
     def checkInfo() -> str | None:
@@ -180,9 +383,9 @@ class JXLEncoderOptions(AbstractEncoderOptions):
             return subprocess.check_output(
                 (os.path.join(binDir, 'cjxl'), '--version'),
                 text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
             ).strip()
-        except FileNotFoundError:
+        except OSError:
             return None
 
     def buildCommand(self, inputFile: str, outputFile: str) -> list[str]:
@@ -192,6 +395,12 @@ class JXLEncoderOptions(AbstractEncoderOptions):
         args.append('--brotli_effort=11')
         args.append('--num_threads=-1')
         args.append(f'--effort={self.effort}')
+        if (probe := probeImage(inputFile)) is not None and probe[0] == 'jpeg':
+            # JPEG输入时cjxl默认进行无损转码，只有明确要求时才这样做
+            args.append(f'--lossless_jpeg={int(self.losslessJpeg)}')
+            if self.losslessJpeg:
+                args.append('--verbose')
+                return args
         args.append(f'--epf={self.epf}')
         args.append(f'--faster_decoding={self.decodingSpeedTier}')
         args.append(f'--photon_noise_iso={self.photonNoiseIso}')
@@ -224,9 +433,26 @@ class JXLEncoderOptions(AbstractEncoderOptions):
         args.append('--verbose')
         return args
 
+    def parseProgress(self, line: str) -> dict[str, typing.Any] | None:
+        if m := re.match(r'Read (\d+)x(\d+) image', line):
+            return {'stage': 'loaded', 'progress': .05, 'width': int(m.group(1)), 'height': int(m.group(2))}
+        if m := re.match(r'Encoding \[(.+)\]', line):
+            return {'stage': 'encoding', 'progress': .1, 'mode': m.group(1)}
+        if m := re.match(r'Compressed to (\d+) bytes', line):
+            return {'stage': 'written', 'progress': 1, 'size': int(m.group(1))}
+        return None
+
 class OxiPNGEncoderOptions(AbstractEncoderOptions):
     level: int
     interlace: bool
+    effortOption = 'level'
+    effortLevels = tuple(range(0, 7))
+    costOptions = ('interlace',)
+    outputFormat = 'png'
+    defaultOptions = {
+        'level': 2,
+        'interlace': False,
+    }
 
     @staticmethod
     def checkInfo() -> str | None:
@@ -234,9 +460,9 @@ class OxiPNGEncoderOptions(AbstractEncoderOptions):
             return subprocess.check_output(
                 (os.path.join(binDir, 'oxipng'), '--version'),
                 text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
             ).strip()
-        except FileNotFoundError:
+        except OSError:
             return None
 
     def buildCommand(self, inputFile: str, outputFile: str) -> list[str]:
@@ -255,6 +481,27 @@ class OxiPNGEncoderOptions(AbstractEncoderOptions):
         args.append(inputFile)
         return args
 
+    def parseProgress(self, line: str) -> dict[str, typing.Any] | None:
+        # oxipng -vv在评估每种filter和压缩参数的组合（trial）后输出一行结果
+        if m := re.search(r'Trying:? (\d+) (?:filters|combinations)', line):
+            self.trialsTotal = int(m.group(1))
+            self.trials = 0
+            return {'stage': 'trials', 'progress': 0., 'trials': 0, 'trialsTotal': self.trialsTotal}
+        if (m := re.search(r'(\d+) bytes', line)) and re.search(r'zc = |Eval:|f = ', line):
+            self.trials = getattr(self, 'trials', 0) + 1
+            self.bestSize = min(getattr(self, 'bestSize', float('inf')), int(m.group(1)))
+            trialsTotal = getattr(self, 'trialsTotal', None)
+            return {
+                'stage': 'trials',
+                'progress': min(self.trials / trialsTotal, 1) if trialsTotal else None,
+                'trials': self.trials,
+                'trialsTotal': trialsTotal,
+                'bestSize': self.bestSize,
+            }
+        if line.startswith('Output:'):
+            return {'stage': 'written', 'progress': 1}
+        return None
+
 class WebPEncoderOptions(AbstractEncoderOptions):
     # https://github.com/GoogleChromeLabs/squoosh/blob/dev/codecs/webp/enc/webp_enc.cpp
     # https://github.com/webmproject/libwebp/blob/main/examples/cwebp.c
@@ -286,6 +533,41 @@ class WebPEncoderOptions(AbstractEncoderOptions):
     near_lossless: int
     use_delta_palette: bool
     use_sharp_yuv: bool
+    effortOption = 'method'
+    effortLevels = tuple(range(0, 7))
+    costOptions = ('lossless',)
+    blockSize = 16
+    inputFormats = ('png', 'jpeg', 'webp')
+    outputFormat = 'webp'
+    defaultOptions = {
+        'quality': 75,
+        'target_size': 0,
+        'target_PSNR': 0,
+        'method': 4,
+        'sns_strength': 50,
+        'filter_strength': 60,
+        'filter_sharpness': 0,
+        'filter_type': True,
+        'partitions': 0,
+        'segments': 4,
+        'pass': 1,
+        'show_compressed': False,
+        'preprocessing': 0,
+        'autofilter': False,
+        'partition_limit': 0,
+        'alpha_compression': True,
+        'alpha_filtering': 1,
+        'alpha_quality': 100,
+        'lossless': False,
+        'exact': 0,
+        'image_hint': 0,
+        'emulate_jpeg_size': False,
+        'thread_level': 0,
+        'low_memory': False,
+        'near_lossless': 100,
+        'use_delta_palette': False,
+        'use_sharp_yuv': False,
+    }
 
     @staticmethod
     def checkInfo() -> str | None:
@@ -293,9 +575,9 @@ class WebPEncoderOptions(AbstractEncoderOptions):
             return subprocess.check_output(
                 (os.path.join(binDir, 'cwebp'), '-version'),
                 text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
             ).strip()
-        except FileNotFoundError:
+        except OSError:
             return None
 
     def buildCommand(self, inputFile: str, outputFile: str) -> list[str]:
@@ -352,22 +634,39 @@ class WebPEncoderOptions(AbstractEncoderOptions):
         if self.use_sharp_yuv:
             args.append('-sharp_yuv')
         args.append('-mt')
+        args.append('-progress')
         args.append('-o')
         args.append(outputFile)
         args.append(inputFile)
         return args
 
+    def parseProgress(self, line: str) -> dict[str, typing.Any] | None:
+        # -progress: "[=====      ]:  45 %"
+        if m := re.search(r'\]:?\s*(\d+)\s*%', line):
+            return {'stage': 'encoding', 'progress': int(m.group(1)) / 100}
+        if m := re.match(r'Output:\s+(\d+) bytes', line):
+            return {'stage': 'written', 'progress': 1, 'size': int(m.group(1))}
+        return None
+
 class JpegliEncoderOptions(AbstractEncoderOptions):
     quality: int
     subsample: int
     xyb: bool
+    blockSize = 16
+    inputFormats = ('png', 'jpeg')
+    outputFormat = 'jpeg'
+    defaultOptions = {
+        'quality': 75,
+        'subsample': 0,
+        'xyb': False,
+    }
 
     @staticmethod
     def checkInfo() -> str | None:
         try:
-            subprocess.check_output((os.path.join(binDir, 'cjpegli'), ), creationflags=subprocess.CREATE_NO_WINDOW)
+            subprocess.check_output((os.path.join(binDir, 'cjpegli'), ), creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
             return 'Available'
-        except FileNotFoundError:
+        except OSError:
             return None
 
     def buildCommand(self, inputFile: str, outputFile: str) -> list[str]:
@@ -384,11 +683,27 @@ class JpegliEncoderOptions(AbstractEncoderOptions):
         args.append('--progressive_level=2')
         return args
 
+    def parseProgress(self, line: str) -> dict[str, typing.Any] | None:
+        if m := re.match(r'Read (\d+)x(\d+) image', line):
+            return {'stage': 'loaded', 'progress': .05, 'width': int(m.group(1)), 'height': int(m.group(2))}
+        if m := re.match(r'Compressed to (\d+) bytes', line):
+            return {'stage': 'written', 'progress': 1, 'size': int(m.group(1))}
+        return None
+
 class PngquantEncoderOptions(AbstractEncoderOptions):
     quality: int
     effort: int
     fs: bool
     strip: bool
+    effortOption = 'effort'
+    effortLevels = tuple(range(1, 12))
+    outputFormat = 'png'
+    defaultOptions = {
+        'quality': 75,
+        'effort': 8,
+        'fs': True,
+        'strip': True,
+    }
 
     @staticmethod
     def checkInfo() -> str | None:
@@ -398,10 +713,10 @@ class PngquantEncoderOptions(AbstractEncoderOptions):
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.PIPE,
                 text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
             ).stderr.strip().splitlines()[0]
             return r if 'pngquant' in r else None
-        except FileNotFoundError:
+        except OSError:
             return None
 
     def buildCommand(self, inputFile: str, outputFile: str) -> list[str]:
@@ -421,6 +736,18 @@ class PngquantEncoderOptions(AbstractEncoderOptions):
         args.append(inputFile)
         return args
 
+    def parseProgress(self, line: str) -> dict[str, typing.Any] | None:
+        line = line.strip()
+        if m := re.search(r'made histogram\.\.\.(\d+) colors found', line):
+            return {'stage': 'histogram', 'progress': .1, 'colors': int(m.group(1))}
+        if m := re.search(r'selecting colors\.\.\.(\d+)%', line):
+            return {'stage': 'selecting', 'progress': .1 + int(m.group(1)) / 100 * .7}
+        if m := re.search(r'mapped image to new colors\.\.\.MSE=([\d.]+) \(Q=(\d+)\)', line):
+            return {'stage': 'remapped', 'progress': .9, 'mse': float(m.group(1)), 'quality': int(m.group(2))}
+        if line.startswith('Quantized'):
+            return {'stage': 'written', 'progress': 1}
+        return None
+
 encoderOptionsClassMapping: dict[str, AbstractEncoderOptions] = {
     'mozJPEG': MozJPEGEncoderOptions,
     'avif': AVIFEncoderOptions,
@@ -433,6 +760,7 @@ encoderOptionsClassMapping: dict[str, AbstractEncoderOptions] = {
 
 class AbstractMetric:
     executable: str
+    limits: runner.Limits = {'wallTime': 300.}
 
     @classmethod
     def check(cls) -> bool:
@@ -443,13 +771,24 @@ class AbstractMetric:
         raise NotImplementedError()
 
     @classmethod
-    def calculate(cls, originalFile: str, distortedFile: str) -> float:
+    def calculate(
+        cls,
+        originalFile: str,
+        distortedFile: str,
+        cancelEvent: threading.Event | None = None,
+        priority: int | None = scheduler.INTERACTIVE_METRICS,
+    ) -> float:
         return cls.parseOutput(
-            subprocess.check_output(
+            runner.run(
                 (os.path.join(binDir, cls.executable), originalFile, distortedFile),
+                stdout=subprocess.PIPE,
                 text=True,
-                creationflags=subprocess.CREATE_NO_WINDOW,
-            ).strip()
+                check=True,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
+                cancelEvent=cancelEvent,
+                limits=cls.limits,
+                priority=priority,
+            ).stdout.strip()
         )
 
 class DSSIMMetric(AbstractMetric):
@@ -480,6 +819,112 @@ metricClassMapping: dict[str, AbstractMetric] = {
     'ssimulacra2': SSIMULACRA2Metric,
 }
 
+class DecodeRun(typing.TypedDict):
+    # Median wall time in seconds
+    time: float
+    # Bytes, None if the platform cannot report it
+    peakMemory: int | None
+
+class DecodeCost(typing.TypedDict):
+    singleThread: DecodeRun
+    # None if the decoder is single-threaded
+    multiThread: DecodeRun | None
+
+class AbstractDecoder:
+    executable: str
+    # Same as `AbstractEncoderOptions.outputFormat` of the encoders producing it
+    inputFormat: str
+    outputSuffix = ''
+    multiThreaded = True
+
+    @classmethod
+    def check(cls) -> bool:
+        return os.path.exists(os.path.join(binDir, cls.executable + ('.exe' if os.name == 'nt' else '')))
+
+    @staticmethod
+    def buildCommand(inputFile: str, outputFile: str, threads: int) -> list[str]:
+        raise NotImplementedError()
+
+    @classmethod
+    def measure(cls, inputFile: str, runs: int = 5, cancelEvent: threading.Event | None = None) -> DecodeCost:
+        '''
+        Decode a file runs times single-threaded and (if supported) multi-threaded after one untimed warmup run.
+        Each run waits for interactive work to finish first instead of being paused by the scheduler,
+        which would distort the timing.
+        '''
+        tempOutput = tempfile.mktemp(cls.outputSuffix)
+        def measureThreads(threads: int) -> DecodeRun:
+            results: list[runner.RunResult] = []
+            try:
+                for i in range(runs + 1):
+                    scheduler.waitIdle(scheduler.BACKGROUND)
+                    r = runner.run(
+                        cls.buildCommand(inputFile, tempOutput, threads),
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        check=True,
+                        creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
+                        cancelEvent=cancelEvent,
+                    )
+                    if i:
+                        results.append(r)
+            finally:
+                if os.path.exists(tempOutput):
+                    os.remove(tempOutput)
+            return {
+                'time': statistics.median(r.wallTime for r in results),
+                'peakMemory': max((r.peakMemory for r in results if r.peakMemory is not None), default=None),
+            }
+        return {
+            'singleThread': measureThreads(1),
+            'multiThread': measureThreads(os.cpu_count() or 1) if cls.multiThreaded else None,
+        }
+
+class DJXLDecoder(AbstractDecoder):
+    executable = 'djxl'
+    inputFormat = 'jxl'
+
+    @staticmethod
+    def buildCommand(inputFile: str, outputFile: str, threads: int) -> list[str]:
+        # 只解码不输出，避免把写文件的时间计算在内
+        return [os.path.join(binDir, 'djxl'), inputFile, '--disable_output', f'--num_threads={threads if threads > 1 else 0}']
+
+class AVIFDecDecoder(AbstractDecoder):
+    executable = 'avifdec'
+    inputFormat = 'avif'
+    # avifdec根据扩展名选择输出格式，y4m不需要压缩，写文件的开销最小
+    outputSuffix = '.y4m'
+
+    @staticmethod
+    def buildCommand(inputFile: str, outputFile: str, threads: int) -> list[str]:
+        return [os.path.join(binDir, 'avifdec'), '--jobs', str(threads), inputFile, outputFile]
+
+class DWebPDecoder(AbstractDecoder):
+    executable = 'dwebp'
+    inputFormat = 'webp'
+    outputSuffix = '.yuv'
+
+    @staticmethod
+    def buildCommand(inputFile: str, outputFile: str, threads: int) -> list[str]:
+        return [os.path.join(binDir, 'dwebp'), inputFile, *(('-mt',) if threads > 1 else ()), '-yuv', '-o', outputFile]
+
+class DJPEGDecoder(AbstractDecoder):
+    executable = 'djpeg'
+    inputFormat = 'jpeg'
+    outputSuffix = '.ppm'
+    multiThreaded = False
+
+    @staticmethod
+    def buildCommand(inputFile: str, outputFile: str, threads: int) -> list[str]:
+        return [os.path.join(binDir, 'djpeg'), '-outfile', outputFile, inputFile]
+
+decoderClassMapping: dict[str, AbstractDecoder] = {
+    'jxl': DJXLDecoder,
+    'avif': AVIFDecDecoder,
+    'webp': DWebPDecoder,
+    'jpeg': DJPEGDecoder,
+}
+
 @functools.cache
 def checkCodec() -> dict[str, str | None]:
     with ThreadPoolExecutor() as executor:
@@ -488,3 +933,7 @@ def checkCodec() -> dict[str, str | None]:
 @functools.cache
 def checkMetric() -> dict[str, bool]:
     return {k: metricClassMapping[k].check() for k in metricClassMapping}
+
+@functools.cache
+def checkDecoder() -> dict[str, bool]:
+    return {k: decoderClassMapping[k].check() for k in decoderClassMapping}
@@ -0,0 +1,158 @@
+import atexit
+import collections
+import contextlib
+import hashlib
+import threading
+import typing
+from multiprocessing import shared_memory
+
+import image_cli
+
+__all__ = [
+    'put',
+    'contains',
+    'acquire',
+    'release',
+    'retain',
+    'borrow',
+]
+
+# 没有被引用的图像最多保留的总字节数，超出后释放最早不再被引用的图像
+maxIdleBytes = 256 * 1024 * 1024
+
+class Entry:
+    def __init__(self, shm: shared_memory.SharedMemory, width: int, height: int, size: int) -> None:
+        self.shm = shm
+        self.width = width
+        self.height = height
+        self.size = size
+        self.refs = 0
+
+    def image(self, handle: str) -> image_cli.ImageData:
+        return {
+            'width': self.width,
+            'height': self.height,
+            'data': self.shm.buf[:self.size],
+            'handle': handle,
+        }
+
+entries: dict[str, Entry] = {}
+# 引用计数为0的图像，按不再被引用的先后排列
+idle: collections.OrderedDict[str, None] = collections.OrderedDict()
+idleBytes = 0
+lock = threading.Lock()
+# 关闭时还有memoryview引用着的共享内存，之后再重试关闭
+closing: list[shared_memory.SharedMemory] = []
+
+def free(handle: str):
+    global idleBytes
+    entry = entries.pop(handle)
+    if handle in idle:
+        del idle[handle]
+        idleBytes -= entry.size
+    try:
+        entry.shm.close()
+    except BufferError:
+        # 还有memoryview引用着这块内存，close已经丢弃了shm.buf，这个条目不能再使用。
+        # 名字仍然可以删除，内存在最后一个memoryview被释放后才能关闭
+        closing.append(entry.shm)
+    entry.shm.unlink()
+
+def retryClose():
+    for shm in tuple(closing):
+        try:
+            shm.close()
+        except BufferError:
+            continue
+        closing.remove(shm)
+
+def evict():
+    retryClose()
+    for handle in tuple(idle):
+        if idleBytes <= maxIdleBytes:
+            break
+        free(handle)
+
+def put(image: image_cli.ImageData) -> str:
+    '''
+    Copy the pixels of an image into shared memory once and return its handle, holding one reference for the caller.
+    Putting the same pixels again returns the same handle.
+    '''
+    global idleBytes
+    data = memoryview(image['data']).cast('B')
+    h = hashlib.blake2b(data, digest_size=16)
+    h.update(f'{image['width']}x{image['height']}'.encode())
+    handle = h.hexdigest()
+    with lock:
+        if (entry := entries.get(handle)) is None:
+            shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+            shm.buf[:data.nbytes] = data
+            entry = entries[handle] = Entry(shm, image['width'], image['height'], data.nbytes)
+        elif handle in idle:
+            del idle[handle]
+            idleBytes -= entry.size
+        entry.refs += 1
+    return handle
+
+def contains(handle: str) -> bool:
+    with lock:
+        return handle in entries
+
+def acquire(handle: str) -> image_cli.ImageData:
+    '''
+    Take a reference to a stored image. Its `data` is a memoryview of the shared memory and is valid until `release`.
+    '''
+    global idleBytes
+    with lock:
+        if (entry := entries.get(handle)) is None:
+            raise RuntimeError(f'Unknown or evicted image: {handle}')
+        if handle in idle:
+            del idle[handle]
+            idleBytes -= entry.size
+        entry.refs += 1
+        return entry.image(handle)
+
+def release(handle: str):
+    global idleBytes
+    with lock:
+        if (entry := entries.get(handle)) is None or entry.refs <= 0:
+            return
+        entry.refs -= 1
+        if entry.refs == 0:
+            idle[handle] = None
+            idleBytes += entry.size
+            evict()
+
+def retain(handle: str) -> tuple[image_cli.ImageData, typing.Callable[[], None]]:
+    '''
+    Like `acquire`, also returning a function that drops the memoryview of the image and releases the reference.
+    '''
+    image = acquire(handle)
+    def releaseImage():
+        # 释放前先丢弃memoryview，否则共享内存无法关闭
+        try:
+            image['data'].release()
+        except BufferError:
+            pass
+        release(handle)
+    return image, releaseImage
+
+@contextlib.contextmanager
+def borrow(handle: str) -> typing.Generator[image_cli.ImageData, None, None]:
+    image, releaseImage = retain(handle)
+    try:
+        yield image
+    finally:
+        releaseImage()
+
+@atexit.register
+def close():
+    with lock:
+        for entry in entries.values():
+            try:
+                entry.shm.close()
+            except BufferError:
+                pass
+            entry.shm.unlink()
+        entries.clear()
+        idle.clear()
@@ -0,0 +1,130 @@
+import collections
+import concurrent.futures
+import threading
+import time
+import traceback
+import typing
+import uuid
+
+import runner
+import scheduler
+
+__all__ = [
+    'JobStatus',
+    'Job',
+    'submit',
+    'get',
+    'wait',
+    'cancel',
+]
+
+# 同时执行的任务数，编码器本身大多是多线程的，因此不需要太多
+maxWorkers = 2
+# 保留的已完成任务的数量，超出后丢弃最早完成的任务
+maxFinished = 32
+
+class JobStatus(typing.TypedDict):
+    id: str
+    fn: str
+    # queued, running, done, error, cancelled
+    status: str
+    created: float
+    started: float | None
+    finished: float | None
+    error: list[str] | None
+    # Last progress reported by the job
+    progress: dict[str, typing.Any] | None
+
+class Job:
+    def __init__(self, fn: str) -> None:
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.status = 'queued'
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.result: typing.Any = None
+        self.error: list[str] | None = None
+        self.progress: dict[str, typing.Any] | None = None
+        self.cancelEvent = threading.Event()
+        self.doneEvent = threading.Event()
+        self.future: concurrent.futures.Future | None = None
+
+    def toDict(self) -> JobStatus:
+        return {
+            'id': self.id,
+            'fn': self.fn,
+            'status': self.status,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error,
+            'progress': self.progress,
+        }
+
+executor = concurrent.futures.ThreadPoolExecutor(maxWorkers, 'job')
+jobs: dict[str, Job] = {}
+finished: collections.OrderedDict[str, None] = collections.OrderedDict()
+lock = threading.Lock()
+
+def finish(job: Job, status: str):
+    with lock:
+        job.status = status
+        job.finished = time.time()
+        finished[job.id] = None
+        while len(finished) > maxFinished:
+            jobs.pop(finished.popitem(last=False)[0], None)
+    job.doneEvent.set()
+
+def execute(job: Job, func: typing.Callable, args: tuple, kwargs: dict):
+    # 交互操作的进程运行时推迟开始，但最多等待一段时间，避免任务一直得不到执行
+    scheduler.waitIdle(scheduler.BACKGROUND)
+    if job.cancelEvent.is_set():
+        finish(job, 'cancelled')
+        return
+    with lock:
+        job.status = 'running'
+        job.started = time.time()
+    try:
+        job.result = func(*args, cancelEvent=job.cancelEvent, job=job, **kwargs)
+    except runner.Cancelled:
+        finish(job, 'cancelled')
+    except Exception as ex:
+        traceback.print_exc()
+        job.error = [type(ex).__name__, str(ex)]
+        finish(job, 'error')
+    else:
+        finish(job, 'cancelled' if job.cancelEvent.is_set() else 'done')
+
+def submit(name: str, func: typing.Callable, *args, **kwargs) -> Job:
+    '''
+    Queue func(*args, cancelEvent=..., job=..., **kwargs) to run in the job executor.
+    func should stop and raise `runner.Cancelled` once cancelEvent is set, and may set `job.progress`.
+    '''
+    job = Job(name)
+    with lock:
+        jobs[job.id] = job
+    job.future = executor.submit(execute, job, func, args, kwargs)
+    return job
+
+def get(id: str) -> Job:
+    with lock:
+        if (job := jobs.get(id)) is None:
+            raise RuntimeError(f'Unknown or expired job: {id}')
+        return job
+
+def wait(id: str, timeout: float | None = None) -> Job:
+    '''
+    Wait until the job finishes or timeout seconds have passed, then return it.
+    '''
+    job = get(id)
+    job.doneEvent.wait(timeout)
+    return job
+
+def cancel(id: str) -> Job:
+    job = get(id)
+    job.cancelEvent.set()
+    # 还没有开始执行的任务直接结束
+    if job.future is not None and job.future.cancel():
+        finish(job, 'cancelled')
+    return job
@@ -1,16 +1,27 @@
+import collections
+import contextlib
+import hashlib
+import numpy
 import os
 import pprint
-import shlex
-import subprocess
 import tempfile
 import threading
-import time
+import traceback
 import typing
 import webview
 import wvruntime
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 
+import api
 import image_cli
+import imagestore
+import jobs
+import pipeline
+import predict
+import preprocess
+import runner
+import scheduler
+import stats
 import svpng
 
 DEBUG = bool(os.environ.get('DEBUG') and not wvruntime.isFrozen)
@@ -34,17 +45,49 @@ def noConcurrency(defaultReturn: typing.Any = None):
 
 def init(window: webview.Window):
     wvruntime.initMsgpackApi(window)
+    api.initTracing(window)
+    api.initJobApi(window)
     wvruntime.exposeDnDHook(window)
 
     @wvruntime.expose(window, 'fileDialog')
     def _(kwargs={}):
         return window.create_file_dialog(**kwargs)
 
+    # readFile打开过的文件，没有进行任何变换时直接把原文件交给编码器
+    sourceFiles: dict[str, tuple[int, int]] = {}
+
     @wvruntime.exposeMsgpack(window, 'readFile')
     def _(file: str, size: int | None = None):
         with open(file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            sourceFiles[os.path.abspath(file)] = (st.st_size, st.st_mtime_ns)
             return f.read(size)
 
+    def sourceFile(image: image_cli.ImageData, source: str | None, state: preprocess.PreprocessorState | None) -> str | None:
+        '''
+        Return the file the pixels were decoded from if it was opened by readFile, is unchanged since,
+        the preprocessor state the frontend applied to the pixels is an identity transform,
+        and the file has no EXIF orientation to apply.
+        '''
+        if source is None or state is None or not preprocess.isIdentity(state):
+            return None
+        if (stat := sourceFiles.get(os.path.abspath(source))) is None:
+            return None
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+        if (st.st_size, st.st_mtime_ns) != stat:
+            return None
+        if 'handle' in image and not imagestore.contains(image['handle']):
+            return None
+        if (probe := image_cli.probeImage(source)) is None or probe[1:3] != (image['width'], image['height']):
+            return None
+        # 浏览器解码时会按照EXIF的方向旋转，而编码器会忽略它，尺寸相同时也无法分辨是否旋转过
+        if probe[3] != 1:
+            return None
+        return source
+
     @wvruntime.exposeMsgpack(window, 'writeFile')
     def _(file: str, data: bytes):
         with open(file, 'wb') as f:
@@ -58,51 +101,326 @@ def init(window: webview.Window):
     def _():
         return image_cli.checkMetric()
 
-    @wvruntime.exposeMsgpack(window, 'compressImage')
-    @noConcurrency(b'')
-    def _(image: image_cli.ImageData, encoderState: image_cli.EncoderState):
+    # 前端可以先把原图放入共享内存，之后只传递handle，编码和计算指标时不再复制像素数据
+    @wvruntime.exposeMsgpack(window, 'storeImage')
+    def _(image: image_cli.ImageData):
+        return imagestore.put(image)
+
+    @wvruntime.exposeMsgpack(window, 'releaseImage')
+    def _(handle: str):
+        imagestore.release(handle)
+
+    @contextlib.contextmanager
+    def useImage(image: image_cli.ImageData) -> typing.Generator[image_cli.ImageData, None, None]:
+        '''
+        Resolve an image passed as pixels, as a handle of `imagestore` or as a handle of a preprocessed image.
+        '''
+        if 'data' not in image and 'handle' in image and imagestore.contains(image['handle']):
+            with imagestore.borrow(image['handle']) as image:
+                yield image
+        else:
+            yield preprocess.resolveImage(image)
+
+    def retainImage(image: image_cli.ImageData) -> tuple[image_cli.ImageData, typing.Callable[[], None]]:
+        '''
+        Take another reference for work that continues after the request returns.
+        Returns the image to use and a function releasing it.
+        '''
+        if isinstance(image['data'], memoryview) and 'handle' in image and imagestore.contains(image['handle']):
+            return imagestore.retain(image['handle'])
+        return image, lambda: None
+
+    @wvruntime.expose(window, 'checkDecoder')
+    def _():
+        return image_cli.checkDecoder()
+
+    @wvruntime.exposeMsgpack(window, 'preprocessImage')
+    def _(image: image_cli.ImageData, state: preprocess.PreprocessorState):
+        with stats.timer('preprocess'), useImage(image) as image:
+            return preprocess.preprocess(image, state)
+
+    @wvruntime.expose(window, 'predictEncode')
+    def _(encoderState: image_cli.EncoderState, width: int, height: int):
+        if encoderState['type'] not in image_cli.encoderOptionsClassMapping:
+            raise RuntimeError(f'Invalid encoder type: {encoderState['type']}')
+        options = encoderState['options']
+        if encoderState.get('deadline') is not None:
+            options = predict.autoEffort(encoderState['type'], options, width * height, encoderState['deadline'])
+        return {
+            'options': options,
+            'prediction': predict.predict(encoderState['type'], options, width * height),
+        }
+
+    def encode(
+        image: image_cli.ImageData,
+        stages: list[image_cli.EncoderStage],
+        cancelEvent: threading.Event | None = None,
+        job: jobs.Job | None = None,
+        source: str | None = None,
+        priority: int = scheduler.INTERACTIVE_ENCODE,
+    ) -> bytes:
+        def onProgress(x: dict[str, typing.Any]):
+            if job is not None:
+                job.progress = x
+                x = {**x, 'job': job.id}
+            wvruntime.dispatchEvent(window, 'encodeprogress', x)
+        r = pipeline.encode(image, stages, cancelEvent, onProgress, source, priority)
+        if len(stages) > 1:
+            wvruntime.dispatchEvent(window, 'encodepipeline', {
+                'width': image['width'],
+                'height': image['height'],
+                'stages': r.stages,
+                **({'job': job.id} if job is not None else {}),
+            })
+        return r.data
+
+    def encoderStages(image: image_cli.ImageData, encoderState: image_cli.EncoderState) -> list[image_cli.EncoderStage]:
         pprint.pprint(encoderState)
         if encoderState['type'] not in image_cli.encoderOptionsClassMapping:
             raise RuntimeError(f'Invalid encoder type: {encoderState['type']}')
         encoderOptionsClass = image_cli.encoderOptionsClassMapping[encoderState['type']]
-        tempInput = tempfile.mktemp('.png')
-        tempOutput = tempfile.mktemp()
-        ts = time.perf_counter()
-        svpng.write(tempInput, image['width'], image['height'], image['data'], True)
-        command = encoderOptionsClass(**encoderState['options']).buildCommand(tempInput, tempOutput)
-        print(shlex.join(command))
-        subprocess.check_call(command, creationflags=(not DEBUG and subprocess.CREATE_NO_WINDOW))
-        te = time.perf_counter()
-        print('Encode time:', te - ts)
-        os.remove(tempInput)
-        with open(tempOutput, 'rb') as f:
-            d = f.read()
-        os.remove(tempOutput)
-        return d
+        options = encoderState['options']
+        if encoderState.get('deadline') is not None:
+            options = predict.autoEffort(encoderState['type'], options, image['width'] * image['height'], encoderState['deadline'])
+            if encoderOptionsClass.effortOption:
+                wvruntime.dispatchEvent(window, 'encodeautoeffort', {
+                    'type': encoderState['type'],
+                    'option': encoderOptionsClass.effortOption,
+                    'value': options[encoderOptionsClass.effortOption],
+                })
+        stage: image_cli.EncoderStage = {'type': encoderState['type'], 'options': options}
+        if 'limits' in encoderState:
+            stage['limits'] = encoderState['limits']
+        stages = [stage, *encoderState.get('pipeline', ())]
+        pipeline.validate(stages)
+        return stages
 
-    @wvruntime.exposeMsgpack(window, 'calculateMetrics')
-    @noConcurrency()
-    def _(original: image_cli.ImageData, distorted: image_cli.ImageData):
+    # 指定了预览区域时，在后台继续进行的完整图像的编码
+    fullEncodeExecutor = ThreadPoolExecutor(1)
+    fullEncode: dict[str, typing.Any] = {'id': 0, 'future': None, 'cancelEvent': threading.Event()}
+    fullEncodeLock = threading.Lock()
+
+    def cancelFullEncode() -> int:
+        with fullEncodeLock:
+            fullEncode['cancelEvent'].set()
+            if fullEncode['future'] is not None:
+                fullEncode['future'].cancel()
+            fullEncode['id'] += 1
+            fullEncode['future'] = None
+            fullEncode['cancelEvent'] = threading.Event()
+            return fullEncode['id']
+
+    @wvruntime.exposeMsgpack(window, 'compressImage')
+    @noConcurrency(b'')
+    def _(
+        image: image_cli.ImageData,
+        encoderState: image_cli.EncoderState,
+        roi: image_cli.Rect | None = None,
+        source: str | None = None,
+        preprocessorState: preprocess.PreprocessorState | None = None,
+    ):
+        with useImage(image) as image:
+            stages = encoderStages(image, encoderState)
+            source = sourceFile(image, source, preprocessorState)
+            # 参数变化后之前的完整图像编码已经没有意义了
+            fullEncodeId = cancelFullEncode()
+            if roi is None:
+                return encode(image, stages, source=source)
+
+            # 先只编码预览区域并返回，完整图像的编码在后台继续，通过fetchFullEncode取得结果
+            cropped, rect = image_cli.cropImage(image, roi, max(image_cli.encoderOptionsClassMapping[x['type']].blockSize for x in stages))
+            preview = encode(cropped, stages)
+            with fullEncodeLock:
+                if fullEncode['id'] == fullEncodeId:
+                    image, releaseImage = retainImage(image)
+                    fullEncode['future'] = fullEncodeExecutor.submit(
+                        encode, image, stages, fullEncode['cancelEvent'], source=source, priority=scheduler.BACKGROUND,
+                    )
+                    fullEncode['future'].add_done_callback(lambda _: releaseImage())
+        return {
+            'id': fullEncodeId,
+            'preview': preview,
+            'roi': rect,
+        }
+
+    # 作为任务提交时不会取消其他编码，可以同时进行多个
+    @api.exposeMsgpackJob(window, 'compressImage')
+    def _(
+        image: image_cli.ImageData,
+        encoderState: image_cli.EncoderState,
+        source: str | None = None,
+        preprocessorState: preprocess.PreprocessorState | None = None,
+        *,
+        cancelEvent: threading.Event,
+        job: jobs.Job,
+    ):
+        with useImage(image) as image:
+            source = sourceFile(image, source, preprocessorState)
+            return encode(image, encoderStages(image, encoderState), cancelEvent, job, source, scheduler.BACKGROUND)
+
+    @wvruntime.exposeMsgpack(window, 'fetchFullEncode')
+    def _(id: int):
+        with fullEncodeLock:
+            future = fullEncode['future'] if fullEncode['id'] == id else None
+        if future is None:
+            return b''
+        try:
+            return future.result()
+        except (runner.Cancelled, CancelledError):
+            return b''
+
+    @wvruntime.exposeMsgpack(window, 'cancelFullEncode')
+    def _():
+        cancelFullEncode()
+
+    def calculateMetrics(
+        original: image_cli.ImageData,
+        distorted: image_cli.ImageData,
+        cancelEvent: threading.Event | None = None,
+        priority: int = scheduler.INTERACTIVE_METRICS,
+    ):
         originalFile = tempfile.mktemp('.png')
         distortedFile = tempfile.mktemp('.png')
-        ts = time.perf_counter()
-        svpng.write(originalFile, original['width'], original['height'], original['data'], True)
-        svpng.write(distortedFile, distorted['width'], distorted['height'], distorted['data'], True)
-        cm = image_cli.checkMetric()
-        with ThreadPoolExecutor() as executor:
-            r = dict((
-                *executor.map(
-                    lambda x: (x, image_cli.metricClassMapping[x].calculate(originalFile, distortedFile)),
-                    (k for k, v in cm.items() if v),
-                ),
-                *((k, None) for k, v in cm.items() if not v),
-            ))
-        te = time.perf_counter()
-        print('Metrics time:', te - ts)
-        os.remove(originalFile)
-        os.remove(distortedFile)
+        with stats.timer('metrics_total'):
+            with stats.timer('scratch_write'):
+                svpng.write(originalFile, original['width'], original['height'], original['data'], True)
+                svpng.write(distortedFile, distorted['width'], distorted['height'], distorted['data'], True)
+            cm = image_cli.checkMetric()
+            def calculate(x: str) -> tuple[str, float]:
+                with stats.timer('metric', metric=x):
+                    return x, image_cli.metricClassMapping[x].calculate(originalFile, distortedFile, cancelEvent, priority)
+            try:
+                with ThreadPoolExecutor() as executor:
+                    r = dict((
+                        *executor.map(calculate, (k for k, v in cm.items() if v)),
+                        *((k, None) for k, v in cm.items() if not v),
+                    ))
+            finally:
+                os.remove(originalFile)
+                os.remove(distortedFile)
         return r
 
+    # 渐进式计算指标时，先返回在抽样图块上估算的结果，完整图像的结果在后台计算，完成或失败后通过metricsexact事件推送
+    metricsTileSize = 128
+    metricsTileGrid = 4
+    metricsCacheSize = 16
+    metricsCache: collections.OrderedDict[tuple[str, bool], dict[str, float | None]] = collections.OrderedDict()
+    metricsExecutor = ThreadPoolExecutor(1)
+    exactMetrics: dict[str, typing.Any] = {'id': None, 'cancelEvent': threading.Event()}
+    metricsLock = threading.Lock()
+
+    def cachedMetrics(
+        id: str,
+        exact: bool,
+        original: image_cli.ImageData,
+        distorted: image_cli.ImageData,
+        cancelEvent: threading.Event | None = None,
+        priority: int = scheduler.INTERACTIVE_METRICS,
+    ):
+        with metricsLock:
+            if (id, exact) in metricsCache:
+                metricsCache.move_to_end((id, exact))
+                return metricsCache[id, exact]
+        r = calculateMetrics(original, distorted, cancelEvent, priority)
+        with metricsLock:
+            metricsCache[id, exact] = r
+            while len(metricsCache) > metricsCacheSize:
+                metricsCache.popitem(last=False)
+        return r
+
+    def calculateExactMetrics(id: str, original: image_cli.ImageData, distorted: image_cli.ImageData, cancelEvent: threading.Event):
+        try:
+            r = cachedMetrics(id, True, original, distorted, cancelEvent, scheduler.BACKGROUND)
+        except runner.Cancelled:
+            return
+        except Exception as ex:
+            traceback.print_exc()
+            # 允许下次请求时重新计算
+            with metricsLock:
+                if exactMetrics['id'] == id:
+                    exactMetrics['id'] = None
+            if not cancelEvent.is_set():
+                wvruntime.dispatchEvent(window, 'metricsexact', {'id': id, 'error': [type(ex).__name__, str(ex)]})
+            return
+        if not cancelEvent.is_set():
+            wvruntime.dispatchEvent(window, 'metricsexact', {'id': id, 'metrics': r})
+
+    def progressiveMetrics(original: image_cli.ImageData, distorted: image_cli.ImageData):
+        h = hashlib.blake2b(original['data'], digest_size=16)
+        h.update(distorted['data'])
+        h.update(f'{original['width']}x{original['height']}'.encode())
+        id = h.hexdigest()
+        with metricsLock:
+            if exactMetrics['id'] != id:
+                # 失真图像已经变化，之前的完整图像的计算已经没有意义了
+                exactMetrics['cancelEvent'].set()
+                exactMetrics['id'] = None
+            if (id, True) in metricsCache:
+                metricsCache.move_to_end((id, True))
+                return {'id': id, 'exact': True, 'metrics': metricsCache[id, True]}
+        tilePixels = (metricsTileSize * metricsTileGrid) ** 2
+        # 图像较小或者某一边不足一个图块时直接计算完整图像
+        if original['width'] * original['height'] <= 2 * tilePixels or min(original['width'], original['height']) < metricsTileSize:
+            return {'id': id, 'exact': True, 'metrics': cachedMetrics(id, True, original, distorted)}
+
+        with metricsLock:
+            if exactMetrics['id'] != id:
+                exactMetrics['id'] = id
+                exactMetrics['cancelEvent'] = threading.Event()
+                retainedOriginal, releaseOriginal = retainImage(original)
+                retainedDistorted, releaseDistorted = retainImage(distorted)
+                future = metricsExecutor.submit(calculateExactMetrics, id, retainedOriginal, retainedDistorted, exactMetrics['cancelEvent'])
+                future.add_done_callback(lambda _: (releaseOriginal(), releaseDistorted()))
+        def tiles(image: image_cli.ImageData) -> image_cli.ImageData:
+            pixels = preprocess.sampleTiles(
+                numpy.frombuffer(image['data'], numpy.uint8).reshape(image['height'], image['width'], 4),
+                metricsTileSize,
+                metricsTileGrid,
+            )
+            return {'width': pixels.shape[1], 'height': pixels.shape[0], 'data': pixels.tobytes()}
+        with stats.timer('metrics_estimate'):
+            r = cachedMetrics(id, False, tiles(original), tiles(distorted))
+        return {'id': id, 'exact': False, 'metrics': r}
+
+    @wvruntime.exposeMsgpack(window, 'calculateMetrics')
+    @noConcurrency()
+    def _(original: image_cli.ImageData, distorted: image_cli.ImageData, progressive: bool = False):
+        with useImage(original) as original, useImage(distorted) as distorted:
+            if progressive:
+                return progressiveMetrics(original, distorted)
+            return calculateMetrics(original, distorted)
+
+    @api.exposeMsgpackJob(window, 'calculateMetrics')
+    def _(original: image_cli.ImageData, distorted: image_cli.ImageData, *, cancelEvent: threading.Event, job: jobs.Job):
+        with useImage(original) as original, useImage(distorted) as distorted:
+            return calculateMetrics(original, distorted, cancelEvent, scheduler.BACKGROUND)
+
+    def measureDecode(encoderType: str, data: bytes, runs: int = 5, cancelEvent: threading.Event | None = None) -> image_cli.DecodeCost | None:
+        if encoderType not in image_cli.encoderOptionsClassMapping:
+            raise RuntimeError(f'Invalid encoder type: {encoderType}')
+        if runs < 1:
+            raise RuntimeError(f'Invalid number of runs: {runs}')
+        format = image_cli.encoderOptionsClassMapping[encoderType].outputFormat
+        if format not in image_cli.decoderClassMapping or not image_cli.checkDecoder()[format]:
+            return None
+        tempInput = tempfile.mktemp('.' + format)
+        with open(tempInput, 'wb') as f:
+            f.write(data)
+        try:
+            with stats.timer('decode_cost', format=format):
+                return image_cli.decoderClassMapping[format].measure(tempInput, runs, cancelEvent)
+        finally:
+            os.remove(tempInput)
+
+    @wvruntime.exposeMsgpack(window, 'measureDecode')
+    @noConcurrency()
+    def _(encoderType: str, data: bytes, runs: int = 5):
+        return measureDecode(encoderType, data, runs)
+
+    @api.exposeMsgpackJob(window, 'measureDecode')
+    def _(encoderType: str, data: bytes, runs: int = 5, *, cancelEvent: threading.Event, job: jobs.Job):
+        return measureDecode(encoderType, data, runs, cancelEvent)
+
     window.evaluate_js('window.dispatchEvent(new CustomEvent("pywebviewapiready"))')
 
 wvruntime.mount('/', (
@@ -111,6 +429,8 @@ wvruntime.mount('/', (
     wvruntime.WVResourceObfuscatedZip(os.path.join(wvruntime.contentPath, 'squoosh.pak'), b'$qu0Osh-N4t1v3!!')
 ))
 
+pipeline.debug = DEBUG
+
 if DEBUG:
     os.environ['QTWEBENGINE_CHROMIUM_FLAGS'] = '--remote-allow-origins=*'
 
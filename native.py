@@ -0,0 +1,314 @@
+import ctypes
+import os
+import threading
+import typing
+
+import image_cli
+import svpng
+
+__all__ = [
+    'available',
+    'encode',
+]
+
+# 只有较小的图像使用进程内编码，此时启动CLI和读写文件的开销比编码本身还大
+maxPixels = 512 * 512
+enabled = True
+
+match (os.name):
+    case 'nt':
+        libraryNames = {'webp': ('libwebp.dll',), 'turbojpeg': ('turbojpeg.dll',)}
+    case 'posix':
+        libraryNames = {'webp': ('libwebp.so', 'libwebp.dylib'), 'turbojpeg': ('libturbojpeg.so', 'libturbojpeg.dylib')}
+    case _:
+        libraryNames = {}
+
+libraries: dict[str, ctypes.CDLL | None] = {}
+librariesLock = threading.Lock()
+
+def loadLibrary(name: str) -> ctypes.CDLL | None:
+    '''
+    Load a shared library from the bin folder, or return None if it is missing.
+    '''
+    with librariesLock:
+        if name in libraries:
+            return libraries[name]
+        libraries[name] = None
+        for file in libraryNames.get(name, ()):
+            try:
+                libraries[name] = ctypes.CDLL(os.path.join(image_cli.binDir, file))
+                break
+            except OSError:
+                continue
+        if libraries[name] is not None:
+            try:
+                setupLibrary[name](libraries[name])
+            except AttributeError as ex:
+                # 库的版本太旧，缺少需要的函数
+                print(f'Unable to use {name} in process:', ex)
+                libraries[name] = None
+        return libraries[name]
+
+# libwebp: https://github.com/webmproject/libwebp/blob/main/src/webp/encode.h
+WEBP_ENCODER_ABI_VERSION = 0x020f
+
+class WebPConfig(ctypes.Structure):
+    _fields_ = (
+        ('lossless', ctypes.c_int),
+        ('quality', ctypes.c_float),
+        ('method', ctypes.c_int),
+        ('image_hint', ctypes.c_int),
+        ('target_size', ctypes.c_int),
+        ('target_PSNR', ctypes.c_float),
+        ('segments', ctypes.c_int),
+        ('sns_strength', ctypes.c_int),
+        ('filter_strength', ctypes.c_int),
+        ('filter_sharpness', ctypes.c_int),
+        ('filter_type', ctypes.c_int),
+        ('autofilter', ctypes.c_int),
+        ('alpha_compression', ctypes.c_int),
+        ('alpha_filtering', ctypes.c_int),
+        ('alpha_quality', ctypes.c_int),
+        ('pass_', ctypes.c_int),
+        ('show_compressed', ctypes.c_int),
+        ('preprocessing', ctypes.c_int),
+        ('partitions', ctypes.c_int),
+        ('partition_limit', ctypes.c_int),
+        ('emulate_jpeg_size', ctypes.c_int),
+        ('thread_level', ctypes.c_int),
+        ('low_memory', ctypes.c_int),
+        ('near_lossless', ctypes.c_int),
+        ('exact', ctypes.c_int),
+        ('use_delta_palette', ctypes.c_int),
+        ('use_sharp_yuv', ctypes.c_int),
+        ('qmin', ctypes.c_int),
+        ('qmax', ctypes.c_int),
+    )
+
+class WebPPicture(ctypes.Structure):
+    _fields_ = (
+        ('use_argb', ctypes.c_int),
+        ('colorspace', ctypes.c_int),
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('y', ctypes.c_void_p),
+        ('u', ctypes.c_void_p),
+        ('v', ctypes.c_void_p),
+        ('y_stride', ctypes.c_int),
+        ('uv_stride', ctypes.c_int),
+        ('a', ctypes.c_void_p),
+        ('a_stride', ctypes.c_int),
+        ('pad1', ctypes.c_uint32 * 2),
+        ('argb', ctypes.c_void_p),
+        ('argb_stride', ctypes.c_int),
+        ('pad2', ctypes.c_uint32 * 3),
+        ('writer', ctypes.c_void_p),
+        ('custom_ptr', ctypes.c_void_p),
+        ('extra_info_type', ctypes.c_int),
+        ('extra_info', ctypes.c_void_p),
+        ('stats', ctypes.c_void_p),
+        ('error_code', ctypes.c_int),
+        ('progress_hook', ctypes.c_void_p),
+        ('user_data', ctypes.c_void_p),
+        ('pad3', ctypes.c_uint32 * 3),
+        ('pad4', ctypes.c_void_p),
+        ('pad5', ctypes.c_void_p),
+        ('pad6', ctypes.c_uint32 * 8),
+        ('memory_', ctypes.c_void_p),
+        ('memory_argb_', ctypes.c_void_p),
+        ('pad7', ctypes.c_void_p * 2),
+    )
+
+class WebPMemoryWriter(ctypes.Structure):
+    _fields_ = (
+        ('mem', ctypes.c_void_p),
+        ('size', ctypes.c_size_t),
+        ('max_size', ctypes.c_size_t),
+        ('pad', ctypes.c_uint32 * 1),
+    )
+
+def setupWebP(lib: ctypes.CDLL):
+    lib.WebPConfigInitInternal.argtypes = (ctypes.POINTER(WebPConfig), ctypes.c_int, ctypes.c_float, ctypes.c_int)
+    lib.WebPConfigInitInternal.restype = ctypes.c_int
+    lib.WebPConfigLosslessPreset.argtypes = (ctypes.POINTER(WebPConfig), ctypes.c_int)
+    lib.WebPConfigLosslessPreset.restype = ctypes.c_int
+    lib.WebPValidateConfig.argtypes = (ctypes.POINTER(WebPConfig),)
+    lib.WebPValidateConfig.restype = ctypes.c_int
+    lib.WebPPictureInitInternal.argtypes = (ctypes.POINTER(WebPPicture), ctypes.c_int)
+    lib.WebPPictureInitInternal.restype = ctypes.c_int
+    lib.WebPPictureImportRGBA.argtypes = (ctypes.POINTER(WebPPicture), ctypes.c_void_p, ctypes.c_int)
+    lib.WebPPictureImportRGBA.restype = ctypes.c_int
+    lib.WebPPictureFree.argtypes = (ctypes.POINTER(WebPPicture),)
+    lib.WebPPictureFree.restype = None
+    lib.WebPMemoryWriterInit.argtypes = (ctypes.POINTER(WebPMemoryWriter),)
+    lib.WebPMemoryWriterInit.restype = None
+    lib.WebPMemoryWriterClear.argtypes = (ctypes.POINTER(WebPMemoryWriter),)
+    lib.WebPMemoryWriterClear.restype = None
+    lib.WebPEncode.argtypes = (ctypes.POINTER(WebPConfig), ctypes.POINTER(WebPPicture))
+    lib.WebPEncode.restype = ctypes.c_int
+
+def encodeWebP(options: image_cli.WebPEncoderOptions, image: image_cli.ImageData) -> bytes | None:
+    if (lib := loadLibrary('webp')) is None:
+        return None
+    # 和WebPEncoderOptions.buildCommand中cwebp的参数对应
+    config = WebPConfig()
+    if not lib.WebPConfigInitInternal(ctypes.byref(config), 0, 75., WEBP_ENCODER_ABI_VERSION):
+        return None
+    config.quality = options.quality
+    config.target_size = options.target_size
+    config.target_PSNR = options.target_PSNR
+    config.method = options.method
+    config.sns_strength = options.sns_strength
+    config.autofilter = int(options.autofilter)
+    if not options.autofilter:
+        config.filter_strength = options.filter_strength
+    config.filter_sharpness = options.filter_sharpness
+    config.filter_type = int(options.filter_type)
+    config.segments = options.segments
+    config.pass_ = getattr(options, 'pass')
+    config.preprocessing = options.preprocessing
+    config.partition_limit = options.partition_limit
+    config.alpha_compression = int(options.alpha_compression)
+    config.alpha_filtering = options.alpha_filtering
+    config.alpha_quality = options.alpha_quality
+    if options.lossless:
+        # -lossless -z 9
+        config.lossless = 1
+        lib.WebPConfigLosslessPreset(ctypes.byref(config), 9)
+        # 和buildCommand相同，0表示不传-near_lossless，保留libwebp的默认值100（关闭）
+        if options.near_lossless:
+            config.near_lossless = options.near_lossless
+    config.exact = int(bool(options.exact))
+    config.image_hint = options.image_hint
+    config.emulate_jpeg_size = int(options.emulate_jpeg_size)
+    config.use_sharp_yuv = int(options.use_sharp_yuv)
+    config.thread_level = 1
+    if not lib.WebPValidateConfig(ctypes.byref(config)):
+        return None
+
+    picture = WebPPicture()
+    if not lib.WebPPictureInitInternal(ctypes.byref(picture), WEBP_ENCODER_ABI_VERSION):
+        return None
+    picture.width = image['width']
+    picture.height = image['height']
+    # 和cwebp相同，这些情况下需要保留ARGB
+    picture.use_argb = int(bool(config.lossless or config.use_sharp_yuv or config.preprocessing > 0))
+    writer = WebPMemoryWriter()
+    lib.WebPMemoryWriterInit(ctypes.byref(writer))
+    picture.writer = ctypes.cast(lib.WebPMemoryWrite, ctypes.c_void_p)
+    picture.custom_ptr = ctypes.addressof(writer)
+    try:
+        if not lib.WebPPictureImportRGBA(ctypes.byref(picture), svpng.bufferPointer(image['data']), image['width'] * 4):
+            return None
+        if not lib.WebPEncode(ctypes.byref(config), ctypes.byref(picture)):
+            print('WebPEncode failed with error code', picture.error_code)
+            return None
+        return ctypes.string_at(writer.mem, writer.size)
+    finally:
+        lib.WebPPictureFree(ctypes.byref(picture))
+        lib.WebPMemoryWriterClear(ctypes.byref(writer))
+
+# TurboJPEG API of mozjpeg: https://github.com/mozilla/mozjpeg/blob/master/turbojpeg.h
+TJPF_RGBA = 7
+TJSAMP_444 = 0
+TJSAMP_420 = 2
+TJSAMP_GRAY = 3
+
+def setupTurboJPEG(lib: ctypes.CDLL):
+    lib.tjInitCompress.argtypes = ()
+    lib.tjInitCompress.restype = ctypes.c_void_p
+    lib.tjCompress2.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_void_p),
+        ctypes.POINTER(ctypes.c_ulong),
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+    )
+    lib.tjCompress2.restype = ctypes.c_int
+    lib.tjGetErrorStr2.argtypes = (ctypes.c_void_p,)
+    lib.tjGetErrorStr2.restype = ctypes.c_char_p
+    lib.tjFree.argtypes = (ctypes.c_void_p,)
+    lib.tjFree.restype = None
+    lib.tjDestroy.argtypes = (ctypes.c_void_p,)
+    lib.tjDestroy.restype = ctypes.c_int
+
+def encodeMozJPEG(options: image_cli.MozJPEGEncoderOptions, image: image_cli.ImageData) -> bytes | None:
+    # TurboJPEG API只能设置质量和色度抽样，其余参数和mozjpeg的默认值不同时使用CLI
+    # 渐进式也使用CLI：buildCommand总是传递-dc-scan-opt 2，TurboJPEG无法设置，扫描脚本会不同
+    if (
+        options.progressive or
+        options.arithmetic or
+        options.smoothing or
+        options.quant_table != 3 or
+        not options.optimize_coding or
+        options.separate_chroma_quality and options.color_space == 3
+    ):
+        return None
+    match options.color_space:
+        case 1:
+            subsample = TJSAMP_GRAY
+        case 3 if options.auto_subsample or options.chroma_subsample == 2:
+            subsample = TJSAMP_420
+        case 3 if options.chroma_subsample == 1:
+            subsample = TJSAMP_444
+        case _:
+            return None
+    if (lib := loadLibrary('turbojpeg')) is None:
+        return None
+    handle = lib.tjInitCompress()
+    if not handle:
+        return None
+    buffer = ctypes.c_void_p()
+    size = ctypes.c_ulong()
+    try:
+        if lib.tjCompress2(
+            handle,
+            svpng.bufferPointer(image['data']),
+            image['width'],
+            image['width'] * 4,
+            image['height'],
+            TJPF_RGBA,
+            ctypes.byref(buffer),
+            ctypes.byref(size),
+            subsample,
+            options.quality,
+            0,
+        ):
+            print('tjCompress2 failed:', lib.tjGetErrorStr2(handle).decode(errors='replace'))
+            return None
+        return ctypes.string_at(buffer, size.value)
+    finally:
+        if buffer:
+            lib.tjFree(buffer)
+        lib.tjDestroy(handle)
+
+setupLibrary: dict[str, typing.Callable[[ctypes.CDLL], None]] = {
+    'webp': setupWebP,
+    'turbojpeg': setupTurboJPEG,
+}
+
+encoders: dict[str, typing.Callable[[typing.Any, image_cli.ImageData], bytes | None]] = {
+    'webP': encodeWebP,
+    'mozJPEG': encodeMozJPEG,
+}
+
+def available(encoderType: str, image: image_cli.ImageData) -> bool:
+    return enabled and encoderType in encoders and image['width'] * image['height'] <= maxPixels
+
+def encode(stage: image_cli.EncoderStage, image: image_cli.ImageData) -> bytes | None:
+    '''
+    Encode an image in process through the shared library of the encoder.
+    Returns None if the encoder has no in-process backend, its library is missing,
+    the options cannot be expressed through the library API or the image is too large,
+    in which case the caller should fall back to the CLI.
+    '''
+    if not available(stage['type'], image):
+        return None
+    options = image_cli.encoderOptionsClassMapping[stage['type']](**stage['options'])
+    return encoders[stage['type']](options, image)
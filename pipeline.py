@@ -0,0 +1,260 @@
+import collections
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+import typing
+
+import image_cli
+import native
+import predict
+import runner
+import stats
+import svpng
+
+__all__ = [
+    'StageReport',
+    'EncodeResult',
+    'validate',
+    'encode',
+]
+
+# 为True时显示CLI的窗口并输出stderr
+debug = False
+
+class StageReport(typing.TypedDict):
+    type: str
+    # Bytes, None for cached stages before the last cached one
+    size: int | None
+    # Seconds, 0 if cached
+    time: float
+    cached: bool
+
+class EncodeResult(typing.NamedTuple):
+    data: bytes
+    stages: list[StageReport]
+
+# 多阶段编码的中间结果，key为输入的hash和到这一阶段为止的参数
+# 缓存的数据最多占用的总字节数，超出后丢弃最早使用的结果，但总是保留最新的结果
+maxCacheBytes = 256 * 1024 * 1024
+cache: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+cacheBytes = 0
+cacheLock = threading.Lock()
+
+def cachePut(key: str, data: bytes):
+    global cacheBytes
+    with cacheLock:
+        if (old := cache.pop(key, None)) is not None:
+            cacheBytes -= len(old)
+        cache[key] = data
+        cacheBytes += len(data)
+        while cacheBytes > maxCacheBytes and len(cache) > 1:
+            cacheBytes -= len(cache.popitem(last=False)[1])
+
+def settingsLabel(encoderType: str, options: dict[str, typing.Any]) -> str:
+    '''
+    Label value of the options that affect encoding cost, the same ones as in `predict.modelKey`.
+    Other options such as quality are left out so that the number of stats series stays bounded.
+    '''
+    encoderOptionsClass = image_cli.encoderOptionsClassMapping[encoderType]
+    return stats.settingsLabel({
+        **({encoderOptionsClass.effortOption: options.get(encoderOptionsClass.effortOption)} if encoderOptionsClass.effortOption else {}),
+        **{k: bool(options.get(k)) for k in encoderOptionsClass.costOptions},
+    })
+
+def validate(stages: list[image_cli.EncoderStage]):
+    '''
+    Raise RuntimeError if an encoder type is unknown or a stage cannot read the output of the previous one.
+    '''
+    if not stages:
+        raise RuntimeError('Empty pipeline')
+    previous = None
+    for stage in stages:
+        if stage['type'] not in image_cli.encoderOptionsClassMapping:
+            raise RuntimeError(f'Invalid encoder type: {stage['type']}')
+        encoderOptionsClass = image_cli.encoderOptionsClassMapping[stage['type']]
+        if previous is not None and previous.outputFormat not in encoderOptionsClass.inputFormats:
+            raise RuntimeError(f'{stage['type']} cannot read {previous.outputFormat} output')
+        previous = encoderOptionsClass
+
+def runStage(
+    inputFile: str,
+    stage: image_cli.EncoderStage,
+    image: image_cli.ImageData,
+    cancelEvent: threading.Event | None,
+    onProgress: typing.Callable[[dict[str, typing.Any]], None] | None,
+    priority: int | None = None,
+) -> tuple[str, runner.RunResult]:
+    '''
+    Run one encoder and return the output file, which the caller should remove.
+    '''
+    encoderType = stage['type']
+    encoderOptionsClass = image_cli.encoderOptionsClassMapping[encoderType]
+    labels = {'encoder': encoderType, 'settings': settingsLabel(encoderType, stage['options'])}
+    tempOutput = tempfile.mktemp('.' + encoderOptionsClass.outputFormat)
+    encoderOptions = encoderOptionsClass(**stage['options'])
+    command = encoderOptions.buildCommand(inputFile, tempOutput)
+    print(shlex.join(command))
+    ts = time.perf_counter()
+    lastEmit = (None, 0.)
+    def onStderrLine(line: str):
+        nonlocal lastEmit
+        if debug:
+            print(line)
+        if onProgress is None or (progress := encoderOptions.parseProgress(line)) is None:
+            return
+        elapsed = time.perf_counter() - ts
+        # 限制推送频率，但阶段变化时总是推送
+        if progress['stage'] == lastEmit[0] and elapsed - lastEmit[1] < .1 and progress.get('progress') != 1:
+            return
+        lastEmit = (progress['stage'], elapsed)
+        p = progress.get('progress')
+        onProgress({
+            'type': encoderType,
+            'width': image['width'],
+            'height': image['height'],
+            'elapsed': elapsed,
+            'eta': elapsed * (1 - p) / p if p else None,
+            **progress,
+        })
+    try:
+        r = runner.run(
+            command,
+            check=True,
+            creationflags=(not debug and getattr(subprocess, 'CREATE_NO_WINDOW', 0)),
+            onStderrLine=onStderrLine,
+            cancelEvent=cancelEvent,
+            limits={**encoderOptionsClass.limits, **stage.get('limits', {})},
+            priority=priority,
+        )
+    except (runner.Cancelled, runner.LimitExceeded, subprocess.CalledProcessError) as ex:
+        status = 'cancelled' if isinstance(ex, runner.Cancelled) else 'limit' if isinstance(ex, runner.LimitExceeded) else 'error'
+        stats.count('encodes_total', status=status, **labels)
+        if os.path.exists(tempOutput):
+            os.remove(tempOutput)
+        raise
+    stats.observe('stage_seconds', r.spawnTime, stage='spawn', **labels)
+    # 被调度器暂停的时间不计算在内
+    stats.observe('stage_seconds', r.wallTime - r.pausedTime, stage='encode_wall', **labels)
+    stats.observe('stage_seconds', r.userTime + r.systemTime, stage='encode_cpu', **labels)
+    stats.observe('bytes', os.path.getsize(inputFile), direction='in', **labels)
+    stats.observe('bytes', os.path.getsize(tempOutput), direction='out', **labels)
+    stats.count('encodes_total', status='ok', **labels)
+    print('Encode time:', r.wallTime - r.pausedTime)
+    return tempOutput, r
+
+def encode(
+    image: image_cli.ImageData,
+    stages: list[image_cli.EncoderStage],
+    cancelEvent: threading.Event | None = None,
+    onProgress: typing.Callable[[dict[str, typing.Any]], None] | None = None,
+    sourceFile: str | None = None,
+    priority: int | None = None,
+) -> EncodeResult:
+    '''
+    Encode an image with one encoder or a chain of encoders, each reading the output of the previous one.
+
+    Parameters
+    ----------
+    image : image_cli.ImageData
+        RGBA pixels.
+    stages : list[image_cli.EncoderStage]
+        Encoders to run in order.
+    cancelEvent : threading.Event | None
+        Kill the running encoder and raise `runner.Cancelled` once set.
+    onProgress : typing.Callable[[dict[str, typing.Any]], None] | None
+        Called with progress parsed from the verbose output of the encoders.
+    sourceFile : str | None
+        The original file the pixels were decoded from. Passed to the first encoder instead of
+        writing the pixels to a PNG if the encoder accepts its format. The caller must make sure
+        the pixels are not transformed.
+    priority : int | None
+        Priority class of the encoders in `scheduler`.
+    '''
+    validate(stages)
+    sourceFormat = None
+    if sourceFile is not None and (probe := image_cli.probeImage(sourceFile)) is not None:
+        if probe[0] in image_cli.encoderOptionsClassMapping[stages[0]['type']].inputFormats:
+            sourceFormat = probe[0]
+    if sourceFormat is None:
+        sourceFile = None
+    # 只有多阶段时才缓存中间结果，单个编码器的结果由前端自己缓存
+    keys: list[str] = []
+    if len(stages) > 1:
+        h = hashlib.blake2b(image['data'], digest_size=16)
+        h.update(f'{image['width']}x{image['height']}'.encode())
+        if sourceFile is not None:
+            st = os.stat(sourceFile)
+            h.update(f'{sourceFile}:{st.st_size}:{st.st_mtime_ns}'.encode())
+        for stage in stages:
+            h.update(json.dumps(stage, sort_keys=True).encode())
+            keys.append(h.copy().hexdigest())
+
+    # 从最后一个已缓存的阶段继续
+    reports: list[StageReport] = []
+    data = None
+    start = 0
+    with cacheLock:
+        for i in range(len(keys) - 1, -1, -1):
+            if keys[i] in cache:
+                cache.move_to_end(keys[i])
+                data = cache[keys[i]]
+                start = i + 1
+                break
+    for stage in stages[:start]:
+        reports.append({'type': stage['type'], 'size': None, 'time': 0., 'cached': True})
+    if start:
+        reports[-1]['size'] = len(data)
+
+    # 较小的图像在进程内编码第一阶段，不支持时使用CLI
+    if start == 0 and sourceFile is None and native.available(stages[0]['type'], image):
+        if cancelEvent is not None and cancelEvent.is_set():
+            raise runner.Cancelled()
+        labels = {'encoder': stages[0]['type'], 'settings': settingsLabel(stages[0]['type'], stages[0]['options'])}
+        ts = time.perf_counter()
+        if (encoded := native.encode(stages[0], image)) is not None:
+            elapsed = time.perf_counter() - ts
+            stats.observe('stage_seconds', elapsed, stage='encode_native', **labels)
+            stats.observe('bytes', len(encoded), direction='out', **labels)
+            stats.count('encodes_total', status='ok', **labels)
+            reports.append({'type': stages[0]['type'], 'size': len(encoded), 'time': elapsed, 'cached': False})
+            data = encoded
+            start = 1
+            if keys:
+                cachePut(keys[0], data)
+
+    tempInput = None
+    try:
+        if start == 0 and sourceFile is None:
+            tempInput = tempfile.mktemp('.png')
+            with stats.timer('scratch_write', encoder=stages[0]['type']):
+                svpng.write(tempInput, image['width'], image['height'], image['data'], True)
+        elif 0 < start < len(stages):
+            tempInput = tempfile.mktemp('.' + image_cli.encoderOptionsClassMapping[stages[start - 1]['type']].outputFormat)
+            with open(tempInput, 'wb') as f:
+                f.write(data)
+        for i in range(start, len(stages)):
+            # 上一阶段的输出文件直接作为下一阶段的输入，原文件只作为第一阶段的输入，不会被删除
+            outputFile, r = runStage(tempInput or sourceFile, stages[i], image, cancelEvent, onProgress, priority)
+            if tempInput is not None:
+                os.remove(tempInput)
+            tempInput = outputFile
+            size = os.path.getsize(outputFile)
+            reports.append({'type': stages[i]['type'], 'size': size, 'time': r.wallTime - r.pausedTime, 'cached': False})
+            # 被调度器降低过优先级的进程耗时不代表正常情况，不作为预测的依据
+            if i == 0 and sourceFormat in (None, 'png') and not r.deprioritized:
+                predict.record(stages[0]['type'], stages[0]['options'], image['width'] * image['height'], r.wallTime - r.pausedTime, size)
+            if keys or i == len(stages) - 1:
+                with stats.timer('output_read', encoder=stages[i]['type']):
+                    with open(outputFile, 'rb') as f:
+                        data = f.read()
+            if keys:
+                cachePut(keys[i], data)
+    finally:
+        if tempInput is not None and os.path.exists(tempInput):
+            os.remove(tempInput)
+    return EncodeResult(data, reports)
@@ -0,0 +1,232 @@
+import json
+import math
+import os
+import statistics
+import sys
+import threading
+import time
+import typing
+import wvruntime
+
+import image_cli
+
+__all__ = [
+    'Prediction',
+    'record',
+    'predict',
+    'autoEffort',
+]
+
+historyFile = os.path.join(wvruntime.executablePath, 'encode-history.jsonl')
+# 每个编码器和effort组合最多使用最近的多少条记录
+maxSamples = 200
+# 没有相邻effort的记录可以参考时，假设每提高一档effort耗时增加多少
+defaultStepFactor = 1.5
+
+class Prediction(typing.TypedDict):
+    # Seconds
+    time: float
+    # Bytes, None if extrapolated from other effort levels
+    size: float | None
+    # Number of samples the model for this effort level is fitted from, 0 if extrapolated
+    samples: int
+
+class Model(typing.NamedTuple):
+    # time = intercept + slope * pixels
+    intercept: float
+    slope: float
+    bytesPerPixel: float
+    samples: int
+
+    def time(self, pixels: int) -> float:
+        return self.intercept + self.slope * pixels
+
+# (type, effort, *costOptions) -> history entries
+history: dict[tuple, list[dict[str, typing.Any]]] | None = None
+models: dict[tuple, Model] = {}
+historyLock = threading.Lock()
+
+def modelKey(encoderType: str, options: dict[str, typing.Any], effort: int | None = None) -> tuple:
+    encoderOptionsClass = image_cli.encoderOptionsClassMapping[encoderType]
+    if effort is None and encoderOptionsClass.effortOption:
+        effort = options.get(encoderOptionsClass.effortOption)
+    return (
+        encoderType,
+        effort,
+        *(bool(options.get(k)) for k in encoderOptionsClass.costOptions),
+    )
+
+def addEntry(entry: dict[str, typing.Any]):
+    key = modelKey(entry['type'], entry['options'])
+    entries = history.setdefault(key, [])
+    entries.append(entry)
+    if len(entries) > maxSamples:
+        del entries[0]
+    models.pop(key, None)
+
+def loadHistory():
+    global history
+    if history is not None:
+        return
+    history = {}
+    try:
+        with open(historyFile, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return
+    for line in lines:
+        try:
+            entry = json.loads(line)
+            if entry['type'] in image_cli.encoderOptionsClassMapping:
+                addEntry(entry)
+        except (ValueError, KeyError):
+            continue
+    # 文件中的记录过多时只保留仍然会用到的部分
+    if len(lines) > 2 * sum(len(x) for x in history.values()):
+        try:
+            with open(historyFile, 'w', encoding='utf-8') as f:
+                for entries in history.values():
+                    for entry in entries:
+                        f.write(json.dumps(entry) + '\n')
+        except OSError as ex:
+            print(f'Unable to compact {historyFile}: {ex}', file=sys.stderr)
+
+def fit(entries: list[dict[str, typing.Any]]) -> Model:
+    '''
+    Least squares fit of time against pixel count.
+    Falls back to time proportional to pixel count when there are too few samples or the fit is not physical.
+    '''
+    xs = [e['pixels'] for e in entries]
+    ys = [e['time'] for e in entries]
+    bytesPerPixel = statistics.median(e['size'] / e['pixels'] for e in entries)
+    mx = statistics.fmean(xs)
+    my = statistics.fmean(ys)
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if len(entries) >= 3 and sxx > 0:
+        slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+        intercept = my - slope * mx
+        if slope > 0 and intercept >= 0:
+            return Model(intercept, slope, bytesPerPixel, len(entries))
+    return Model(0., statistics.median(y / x for x, y in zip(xs, ys)), bytesPerPixel, len(entries))
+
+def getModel(key: tuple) -> Model | None:
+    if key in models:
+        return models[key]
+    if not (entries := history.get(key)):
+        return None
+    models[key] = fit(entries)
+    return models[key]
+
+def predictLocked(encoderType: str, options: dict[str, typing.Any], pixels: int) -> Prediction | None:
+    encoderOptionsClass = image_cli.encoderOptionsClassMapping[encoderType]
+    if (model := getModel(modelKey(encoderType, options))) is not None:
+        return {'time': model.time(pixels), 'size': model.bytesPerPixel * pixels, 'samples': model.samples}
+    effort = options.get(encoderOptionsClass.effortOption) if encoderOptionsClass.effortOption else None
+    if effort not in encoderOptionsClass.effortLevels:
+        return None
+
+    # 没有这一档effort的记录，使用其他effort的记录在对数尺度上插值或外推，结果只供参考，autoEffort不会使用
+    levels = encoderOptionsClass.effortLevels
+    known = [
+        (i, math.log(model.time(pixels)))
+        for i, level in enumerate(levels)
+        if (model := getModel(modelKey(encoderType, options, level))) is not None and model.time(pixels) > 0
+    ]
+    if not known:
+        return None
+    index = levels.index(effort)
+    lower = [x for x in known if x[0] < index]
+    upper = [x for x in known if x[0] > index]
+    if lower and upper:
+        (i0, t0), (i1, t1) = lower[-1], upper[0]
+        logTime = t0 + (t1 - t0) * (index - i0) / (i1 - i0)
+    else:
+        if len(known) >= 2:
+            step = (known[-1][1] - known[0][1]) / (known[-1][0] - known[0][0])
+        else:
+            step = math.log(defaultStepFactor)
+        i0, t0 = lower[-1] if lower else upper[0]
+        logTime = t0 + step * (index - i0)
+    return {'time': math.exp(logTime), 'size': None, 'samples': 0}
+
+def predict(encoderType: str, options: dict[str, typing.Any], pixels: int) -> Prediction | None:
+    '''
+    Predict encoding time and output size from the history of previous encodes.
+
+    Parameters
+    ----------
+    encoderType : str
+        Key of `image_cli.encoderOptionsClassMapping`.
+    options : dict[str, typing.Any]
+        Encoder options.
+    pixels : int
+        Width * height of the input.
+
+    Returns
+    -------
+    Prediction | None
+        None if there is no usable history for this encoder yet.
+    '''
+    with historyLock:
+        loadHistory()
+        return predictLocked(encoderType, options, pixels)
+
+def autoEffort(encoderType: str, options: dict[str, typing.Any], pixels: int, deadline: float) -> dict[str, typing.Any]:
+    '''
+    Return a copy of options with the slowest effort level predicted to finish within deadline seconds.
+    Only levels with recorded encodes are chosen, predictions extrapolated from other levels are too unreliable.
+    Uses the fastest recorded level if none fits, and keeps the options unchanged if there is nothing to predict from.
+    '''
+    encoderOptionsClass = image_cli.encoderOptionsClassMapping[encoderType]
+    if not encoderOptionsClass.effortOption:
+        return options
+    with historyLock:
+        loadHistory()
+        chosen = None
+        for level in encoderOptionsClass.effortLevels:
+            if (p := predictLocked(encoderType, {**options, encoderOptionsClass.effortOption: level}, pixels)) is None:
+                return options
+            if p['samples'] == 0:
+                continue
+            if chosen is None or p['time'] <= deadline:
+                chosen = level
+    if chosen is None:
+        return options
+    return {**options, encoderOptionsClass.effortOption: chosen}
+
+def record(encoderType: str, options: dict[str, typing.Any], pixels: int, elapsed: float, size: int):
+    '''
+    Add a finished encode to the history used by `predict`.
+
+    Parameters
+    ----------
+    encoderType : str
+        Key of `image_cli.encoderOptionsClassMapping`.
+    options : dict[str, typing.Any]
+        Encoder options.
+    pixels : int
+        Width * height of the input.
+    elapsed : float
+        Measured encoding time in seconds.
+    size : int
+        Output size in bytes.
+    '''
+    if pixels <= 0:
+        return
+    entry = {
+        'type': encoderType,
+        'options': options,
+        'pixels': pixels,
+        'time': elapsed,
+        'size': size,
+        'ts': time.time(),
+    }
+    with historyLock:
+        loadHistory()
+        addEntry(entry)
+        # 无法写入时只在内存中保留记录，不影响编码
+        try:
+            with open(historyFile, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError as ex:
+            print(f'Unable to write {historyFile}: {ex}', file=sys.stderr)
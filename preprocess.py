@@ -0,0 +1,273 @@
+import collections
+import hashlib
+import json
+import math
+import threading
+import typing
+
+import numpy as np
+
+import image_cli
+
+__all__ = [
+    'ResizeOptions',
+    'QuantizeOptions',
+    'RotateOptions',
+    'PreprocessorState',
+    'resize',
+    'quantize',
+    'sampleTiles',
+    'preprocess',
+    'resolveImage',
+    'isIdentity',
+]
+
+class ResizeOptions(typing.TypedDict):
+    enabled: bool
+    width: int
+    height: int
+    # box, triangle, catrom, mitchell, lanczos3
+    method: str
+    premultiply: bool
+    linearRGB: bool
+
+class QuantizeOptions(typing.TypedDict):
+    enabled: bool
+    numColors: int
+    # 0 ~ 1
+    dither: float
+
+class RotateOptions(typing.TypedDict):
+    # 0, 90, 180, 270, applied by the frontend
+    rotate: int
+
+class PreprocessorState(typing.TypedDict):
+    rotate: typing.NotRequired[RotateOptions]
+    resize: typing.NotRequired[ResizeOptions]
+    quantize: typing.NotRequired[QuantizeOptions]
+
+def cubic(b: float, c: float) -> typing.Callable[[np.ndarray], np.ndarray]:
+    # Mitchell-Netravali family
+    def f(x: np.ndarray) -> np.ndarray:
+        x = np.abs(x)
+        return np.where(
+            x < 1,
+            ((12 - 9 * b - 6 * c) * x ** 3 + (-18 + 12 * b + 6 * c) * x ** 2 + (6 - 2 * b)) / 6,
+            np.where(
+                x < 2,
+                ((-b - 6 * c) * x ** 3 + (6 * b + 30 * c) * x ** 2 + (-12 * b - 48 * c) * x + (8 * b + 24 * c)) / 6,
+                0,
+            ),
+        )
+    return f
+
+# name -> (filter function, support radius)
+filters: dict[str, tuple[typing.Callable[[np.ndarray], np.ndarray], float]] = {
+    'box': (lambda x: ((x >= -.5) & (x < .5)).astype(np.float64), .5),
+    'triangle': (lambda x: np.maximum(1 - np.abs(x), 0), 1),
+    'catrom': (cubic(0, .5), 2),
+    'mitchell': (cubic(1 / 3, 1 / 3), 2),
+    'lanczos3': (lambda x: np.where(np.abs(x) < 3, np.sinc(x) * np.sinc(x / 3), 0), 3),
+}
+
+def weights(inSize: int, outSize: int, method: str) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Source indices and normalized weights, both of shape (outSize, taps), for resampling one axis.
+    '''
+    f, support = filters[method]
+    scale = inSize / outSize
+    # 缩小时按比例放大filter，起到低通的作用
+    filterScale = max(scale, 1)
+    center = (np.arange(outSize) + .5) * scale - .5
+    taps = math.ceil(support * filterScale) * 2 + 1
+    first = np.floor(center - support * filterScale).astype(np.int64)
+    index = first[:, None] + np.arange(taps)[None, :]
+    w = f((index - center[:, None]) / filterScale)
+    w /= w.sum(axis=1, keepdims=True)
+    return np.clip(index, 0, inSize - 1), w.astype(np.float32)
+
+def resampleAxis(pixels: np.ndarray, outSize: int, method: str, axis: int) -> np.ndarray:
+    index, w = weights(pixels.shape[axis], outSize, method)
+    shape = [1] * pixels.ndim
+    shape[axis] = outSize
+    r = np.zeros((*pixels.shape[:axis], outSize, *pixels.shape[axis + 1:]), np.float32)
+    for t in range(index.shape[1]):
+        r += np.take(pixels, index[:, t], axis=axis) * w[:, t].reshape(shape)
+    return r
+
+def srgbToLinear(x: np.ndarray) -> np.ndarray:
+    return np.where(x <= .04045, x / 12.92, ((x + .055) / 1.055) ** 2.4)
+
+def linearToSrgb(x: np.ndarray) -> np.ndarray:
+    return np.where(x <= .0031308, x * 12.92, 1.055 * np.power(np.maximum(x, 0), 1 / 2.4) - .055)
+
+def resize(pixels: np.ndarray, width: int, height: int, method: str = 'lanczos3', premultiply: bool = True, linearRGB: bool = True) -> np.ndarray:
+    '''
+    Resize an RGBA image with a separable filter.
+
+    Parameters
+    ----------
+    pixels : np.ndarray
+        uint8 array of shape (height, width, 4).
+    width, height : int
+        Output size.
+    method : str
+        One of `filters`.
+    premultiply : bool
+        Resample with premultiplied alpha so transparent pixels don't bleed their color.
+    linearRGB : bool
+        Resample in linear light instead of sRGB.
+    '''
+    if method not in filters:
+        raise ValueError(f'Invalid resize method: {method}')
+    x = pixels.astype(np.float32) / 255
+    if linearRGB:
+        x[..., :3] = srgbToLinear(x[..., :3])
+    if premultiply:
+        x[..., :3] *= x[..., 3:]
+    x = resampleAxis(x, height, method, 0)
+    x = resampleAxis(x, width, method, 1)
+    np.clip(x, 0, 1, out=x)
+    if premultiply:
+        alpha = x[..., 3:]
+        np.divide(x[..., :3], alpha, out=x[..., :3], where=alpha > 0)
+        np.clip(x, 0, 1, out=x)
+    if linearRGB:
+        x[..., :3] = linearToSrgb(x[..., :3])
+    return (x * 255 + .5).astype(np.uint8)
+
+# 4x4 Bayer matrix, normalized to (-0.5, 0.5)
+bayer = (np.array((
+    (0, 8, 2, 10),
+    (12, 4, 14, 6),
+    (3, 11, 1, 9),
+    (15, 7, 13, 5),
+), np.float32) + .5) / 16 - .5
+
+def medianCut(colors: np.ndarray, numColors: int) -> np.ndarray:
+    def score(box: np.ndarray) -> float:
+        # 优先切分像素数和颜色范围的乘积最大的盒子
+        return len(box) * float(np.ptp(box, axis=0).max()) if len(box) > 1 else -1.
+
+    boxes = [colors]
+    scores = [score(colors)]
+    while len(boxes) < numColors:
+        i = max(range(len(boxes)), key=scores.__getitem__)
+        if scores[i] <= 0:
+            break
+        box = boxes[i]
+        channel = np.ptp(box, axis=0).argmax()
+        box = box[box[:, channel].argsort(kind='stable')]
+        boxes[i:i + 1] = (box[:len(box) // 2], box[len(box) // 2:])
+        scores[i:i + 1] = (score(boxes[i]), score(boxes[i + 1]))
+    return np.array([b.mean(axis=0) for b in boxes], np.float32)
+
+def quantize(pixels: np.ndarray, numColors: int = 256, dither: float = 1.) -> np.ndarray:
+    '''
+    Reduce an RGBA image to at most numColors colors (including alpha) with median cut.
+    Dithering is ordered (Bayer) rather than error diffusion so that it vectorizes.
+
+    Parameters
+    ----------
+    pixels : np.ndarray
+        uint8 array of shape (height, width, 4).
+    numColors : int
+        Palette size, 2 ~ 256.
+    dither : float
+        Dithering strength, 0 ~ 1.
+    '''
+    h, w, _ = pixels.shape
+    flat = pixels.reshape(-1, 4)
+    # 颜色较多时从抽样的像素生成调色板
+    sample = flat[::max(len(flat) // 65536, 1)].astype(np.float32)
+    palette = medianCut(sample, max(2, min(numColors, 256)))
+    x = pixels.astype(np.float32)
+    if dither > 0:
+        # 抖动幅度取调色板中相邻颜色的平均间距
+        spread = 255 / max(len(palette) ** (1 / 3), 1) * dither
+        x += np.tile(bayer, (h // 4 + 1, w // 4 + 1))[:h, :w, None] * spread
+    x = x.reshape(-1, 4)
+    index = np.empty(len(x), np.intp)
+    # |x - p|^2 = |x|^2 - 2x·p + |p|^2，其中|x|^2不影响argmin
+    # 分块计算最近颜色，避免一次性生成过大的距离矩阵
+    paletteNorm = (palette ** 2).sum(axis=1)
+    for i in range(0, len(x), 65536):
+        index[i:i + 65536] = (paletteNorm[None, :] - 2 * x[i:i + 65536] @ palette.T).argmin(axis=1)
+    return np.clip(palette + .5, 0, 255).astype(np.uint8)[index].reshape(h, w, 4)
+
+def sampleTiles(pixels: np.ndarray, tileSize: int = 128, grid: int = 4) -> np.ndarray:
+    '''
+    Mosaic of up to grid * grid tiles taken at evenly spaced positions, used to estimate metrics of large images.
+    Tiles keep their full resolution so that compression artifacts are not smoothed out as they would be by downscaling,
+    and their origins are multiples of tileSize so that the block grid of the codec is kept.
+    Both sides of the image must be at least tileSize.
+    '''
+    h, w, _ = pixels.shape
+    rows = np.linspace(0, h // tileSize - 1, min(grid, h // tileSize)).round().astype(np.intp) * tileSize
+    cols = np.linspace(0, w // tileSize - 1, min(grid, w // tileSize)).round().astype(np.intp) * tileSize
+    return np.concatenate([
+        np.concatenate([pixels[y:y + tileSize, x:x + tileSize] for x in cols], axis=1)
+        for y in rows
+    ], axis=0)
+
+# 预处理结果的缓存，key为输入的hash和参数
+# 缓存的像素数据最多占用的总字节数，超出后丢弃最早使用的结果，但总是保留最新的结果
+maxCacheBytes = 256 * 1024 * 1024
+cache: collections.OrderedDict[str, image_cli.ImageData] = collections.OrderedDict()
+cacheBytes = 0
+cacheLock = threading.Lock()
+
+def preprocess(image: image_cli.ImageData, state: PreprocessorState) -> image_cli.ImageData:
+    '''
+    Resize and/or quantize an image. Results are cached, the returned image has a `handle`
+    that can be passed to `resolveImage` instead of the pixel data.
+    '''
+    global cacheBytes
+    h = hashlib.blake2b(image['data'], digest_size=16)
+    h.update(json.dumps((image['width'], image['height'], state), sort_keys=True).encode())
+    handle = h.hexdigest()
+    with cacheLock:
+        if handle in cache:
+            cache.move_to_end(handle)
+            return cache[handle]
+
+    pixels = np.frombuffer(image['data'], np.uint8).reshape(image['height'], image['width'], 4)
+    if (r := state.get('resize')) and r['enabled'] and (r['width'], r['height']) != (image['width'], image['height']):
+        pixels = resize(pixels, r['width'], r['height'], r['method'], r['premultiply'], r['linearRGB'])
+    if (q := state.get('quantize')) and q['enabled']:
+        pixels = quantize(pixels, q['numColors'], q['dither'])
+    result: image_cli.ImageData = {
+        'width': pixels.shape[1],
+        'height': pixels.shape[0],
+        'data': pixels.tobytes(),
+        'handle': handle,
+    }
+
+    with cacheLock:
+        if (old := cache.pop(handle, None)) is not None:
+            cacheBytes -= len(old['data'])
+        cache[handle] = result
+        cacheBytes += len(result['data'])
+        while cacheBytes > maxCacheBytes and len(cache) > 1:
+            cacheBytes -= len(cache.popitem(last=False)[1]['data'])
+    return result
+
+def resolveImage(image: image_cli.ImageData) -> image_cli.ImageData:
+    '''
+    Replace an image that only carries a `handle` with the cached preprocessed image.
+    '''
+    if 'data' in image or 'handle' not in image:
+        return image
+    with cacheLock:
+        if image['handle'] not in cache:
+            raise RuntimeError(f'Preprocessed image has been evicted: {image['handle']}')
+        cache.move_to_end(image['handle'])
+        return cache[image['handle']]
+
+def isIdentity(state: PreprocessorState) -> bool:
+    '''
+    Whether the preprocessing leaves the decoded pixels unchanged: no rotation, resizing or quantization.
+    '''
+    if (r := state.get('rotate')) and r['rotate'] % 360:
+        return False
+    return not any((x := state.get(k)) and x['enabled'] for k in ('resize', 'quantize'))
@@ -0,0 +1,412 @@
+import heapq
+import math
+import os
+import re
+import scheduler
+import stats
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import tracing
+import typing
+
+__all__ = [
+    'Cancelled',
+    'LimitExceeded',
+    'Limits',
+    'RunResult',
+    'Process',
+    'run',
+]
+
+match (os.name):
+    case 'nt':
+        import ctypes
+        import ctypes.wintypes
+
+        kernel32 = ctypes.windll.kernel32
+        kernel32.GetProcessTimes.argtypes = (ctypes.wintypes.HANDLE, *(ctypes.POINTER(ctypes.wintypes.FILETIME),) * 4)
+        kernel32.GetProcessTimes.restype = ctypes.wintypes.BOOL
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = (
+                ('cb', ctypes.wintypes.DWORD),
+                ('PageFaultCount', ctypes.wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t),
+                ('PeakPagefileUsage', ctypes.c_size_t),
+            )
+
+        kernel32.K32GetProcessMemoryInfo.argtypes = (ctypes.wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), ctypes.wintypes.DWORD)
+        kernel32.K32GetProcessMemoryInfo.restype = ctypes.wintypes.BOOL
+    case 'posix':
+        import ctypes
+        import ctypes.util
+        import platform
+        import resource
+        import signal
+
+        # ioprio_set没有libc的包装，只能通过syscall调用
+        ioprioSetSyscall = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'armv7l': 314}.get(platform.machine())
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True) if sys.platform == 'linux' else None
+    case _:
+        raise NotImplementedError(f'Not supported on os.name = {os.name}')
+
+class Cancelled(Exception):
+    pass
+
+class Limits(typing.TypedDict, total=False):
+    # Seconds of wall-clock time before the watchdog kills the process
+    wallTime: float
+    # Seconds of CPU time (RLIMIT_CPU), not enforced on Windows
+    cpuTime: float
+    # Bytes of virtual address space (RLIMIT_AS), not enforced on Windows
+    addressSpace: int
+    # Added to the niceness of the process. On Windows > 0 is below normal and >= 10 is idle priority class
+    nice: int
+    # 0 ~ 7 in the best-effort I/O scheduling class, or -1 for the idle class (Linux only)
+    ioPriority: int
+
+class LimitExceeded(Exception):
+    def __init__(self, command: typing.Sequence[str], kind: str, limit: float) -> None:
+        super().__init__(f'{os.path.basename(command[0])} exceeded its {kind} limit of {limit}')
+        self.command = command
+        self.kind = kind
+        self.limit = limit
+
+class RunResult(typing.NamedTuple):
+    returncode: int
+    stdout: bytes | str | None
+    stderr: bytes | str | None
+    # Time for Popen to return
+    spawnTime: float
+    # Time from spawning to reaping the child process
+    wallTime: float
+    userTime: float
+    systemTime: float
+    # Peak resident set size in bytes
+    peakMemory: int | None
+    # Seconds of wallTime the process spent paused by `scheduler`
+    pausedTime: float = 0.
+    # Whether `scheduler` resumed the process with a lower priority after pausing it for too long
+    deprioritized: bool = False
+
+class Process:
+    '''
+    A running child process that can be killed from other threads without racing against reaping it.
+    '''
+    def __init__(self, popen: subprocess.Popen) -> None:
+        self.popen = popen
+        self.pid = popen.pid
+        self.lock = threading.Lock()
+        self.reaped = False
+        self.killed = False
+        self.timedOut = False
+        self.done = threading.Event()
+
+    def kill(self):
+        with self.lock:
+            if self.reaped:
+                return
+            self.killed = True
+            if os.name == 'posix':
+                os.kill(self.pid, signal.SIGKILL)
+            else:
+                self.popen.kill()
+
+    def wait(self) -> tuple[float, float, int | None]:
+        '''
+        Reap the process and return its user time, system time and peak memory.
+        '''
+        p = self.popen
+        if os.name == 'posix':
+            # 先等待子进程退出但不回收，避免kill时pid已经被复用
+            os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT)
+            with self.lock:
+                # 由wait4回收子进程，以取得这个子进程自己的资源占用
+                _, status, rusage = os.wait4(self.pid, 0)
+                p.returncode = os.waitstatus_to_exitcode(status)
+                self.reaped = True
+            userTime, systemTime = rusage.ru_utime, rusage.ru_stime
+            # Linux下ru_maxrss的单位是KiB，macOS下是byte
+            peakMemory = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        else:
+            p.wait()
+            with self.lock:
+                self.reaped = True
+            creation, exited, kernel, user = (ctypes.wintypes.FILETIME() for _ in range(4))
+            if kernel32.GetProcessTimes(int(p._handle), *(ctypes.byref(x) for x in (creation, exited, kernel, user))):
+                # FILETIME的单位是100ns
+                userTime = (user.dwHighDateTime << 32 | user.dwLowDateTime) / 1e7
+                systemTime = (kernel.dwHighDateTime << 32 | kernel.dwLowDateTime) / 1e7
+            else:
+                userTime = systemTime = 0.
+            counters = PROCESS_MEMORY_COUNTERS(cb=ctypes.sizeof(PROCESS_MEMORY_COUNTERS))
+            if kernel32.K32GetProcessMemoryInfo(int(p._handle), ctypes.byref(counters), counters.cb):
+                peakMemory = counters.PeakWorkingSetSize
+            else:
+                peakMemory = None
+        self.done.set()
+        return userTime, systemTime, peakMemory
+
+class Watchdog:
+    '''
+    Kills processes that are still running after their wall-clock deadline, from one shared thread.
+    '''
+    def __init__(self) -> None:
+        # (deadline, counter, process, paused seconds already added to the deadline)
+        self.heap: list[tuple[float, int, Process, float]] = []
+        self.counter = 0
+        self.condition = threading.Condition()
+        self.thread: threading.Thread | None = None
+
+    def watch(self, process: Process, timeout: float):
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.heap, (time.monotonic() + timeout, self.counter, process, 0.))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='watchdog', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        with self.condition:
+            while True:
+                # 已经结束的进程不需要再等待
+                while self.heap and self.heap[0][2].done.is_set():
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline, counter, process, credited = self.heap[0]
+                if (remaining := deadline - time.monotonic()) > 0:
+                    self.condition.wait(min(remaining, 1.))
+                    continue
+                heapq.heappop(self.heap)
+                # 被调度器暂停的时间不计算在内
+                if (paused := scheduler.pausedSeconds(process)) > credited:
+                    heapq.heappush(self.heap, (deadline + paused - credited, counter, process, paused))
+                    continue
+                process.timedOut = True
+                process.kill()
+
+watchdog = Watchdog()
+
+def applyLimits(pid: int, limits: Limits):
+    '''
+    Apply resource limits and priorities to a process that has just been spawned (POSIX).
+    Done from the parent instead of preexec_fn, which is not safe in a program with threads.
+    A limit that cannot be applied (e.g. a negative nice value without privileges) is reported and skipped.
+    '''
+    def apply(name: str, f: typing.Callable, *args):
+        try:
+            f(*args)
+        except ProcessLookupError:
+            # 进程已经退出了
+            pass
+        except OSError as ex:
+            print(f'Unable to apply {name} to pid {pid}: {ex}', file=sys.stderr)
+
+    # prlimit只有Linux有
+    if 'cpuTime' in limits and hasattr(resource, 'prlimit'):
+        seconds = math.ceil(limits['cpuTime'])
+        # 超过软限制时收到SIGXCPU，再超过1秒收到SIGKILL
+        apply('cpuTime', resource.prlimit, pid, resource.RLIMIT_CPU, (seconds, seconds + 1))
+    if 'addressSpace' in limits and hasattr(resource, 'prlimit'):
+        apply('addressSpace', resource.prlimit, pid, resource.RLIMIT_AS, (limits['addressSpace'], limits['addressSpace']))
+    if limits.get('nice'):
+        apply('nice', os.setpriority, os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, 0) + limits['nice'])
+    if 'ioPriority' in limits and libc is not None and ioprioSetSyscall is not None:
+        # IOPRIO_WHO_PROCESS, (class << 13) | data，class 2为best-effort，3为idle
+        prio = 3 << 13 if limits['ioPriority'] < 0 else 2 << 13 | min(limits['ioPriority'], 7)
+        apply('ioPriority', libc.syscall, ioprioSetSyscall, 1, pid, prio)
+
+def checkLimits(command: typing.Sequence[str], process: Process, result: 'RunResult', limits: Limits):
+    '''
+    Raise LimitExceeded if the process was killed by the watchdog or (most likely) failed because of a resource limit.
+    '''
+    kind = None
+    stderr = result.stderr.decode(errors='replace') if isinstance(result.stderr, bytes) else result.stderr or ''
+    if process.timedOut:
+        kind = 'wallTime'
+    elif os.name == 'posix' and result.returncode:
+        if 'cpuTime' in limits and (
+            result.returncode == -signal.SIGXCPU or
+            result.returncode == -signal.SIGKILL and not process.killed and result.userTime + result.systemTime >= limits['cpuTime']
+        ):
+            kind = 'cpuTime'
+        elif 'addressSpace' in limits and (
+            result.returncode in (-signal.SIGABRT, -signal.SIGSEGV) or re.search(r'(?i)memory|alloc', stderr)
+        ):
+            kind = 'addressSpace'
+    if kind is None:
+        return
+    name = os.path.basename(command[0])
+    stats.count('limits_exceeded_total', kind=kind, command=name)
+    print(f'{name} exceeded its {kind} limit of {limits[kind]} (pid {process.pid}, {result.wallTime:.1f}s wall, {result.userTime + result.systemTime:.1f}s CPU)', file=sys.stderr)
+    raise LimitExceeded(command, kind, limits[kind])
+
+def readPipe(pipe: typing.BinaryIO, chunks: list[bytes], onLine: typing.Callable[[str], None] | None = None):
+    if onLine is None:
+        chunks.append(pipe.read())
+        pipe.close()
+        return
+    # 进度条一般使用\r覆盖当前行，所以也作为换行处理
+    buffer = b''
+    while chunk := pipe.read1(65536):
+        chunks.append(chunk)
+        *lines, buffer = re.split(rb'\r\n|\r|\n', buffer + chunk)
+        for line in lines:
+            if not line:
+                continue
+            try:
+                onLine(line.decode(errors='replace'))
+            except Exception:
+                traceback.print_exc()
+    if buffer:
+        try:
+            onLine(buffer.decode(errors='replace'))
+        except Exception:
+            traceback.print_exc()
+    pipe.close()
+
+def run(
+    command: typing.Sequence[str],
+    *,
+    stdout: int | None = None,
+    stderr: int | None = None,
+    text: bool = False,
+    check: bool = False,
+    creationflags: int = 0,
+    onStderrLine: typing.Callable[[str], None] | None = None,
+    cancelEvent: threading.Event | None = None,
+    limits: Limits | None = None,
+    priority: int | None = None,
+) -> RunResult:
+    '''
+    Run a command like `subprocess.run`, also measuring spawn time and the CPU time used by the child process.
+
+    Parameters
+    ----------
+    command : typing.Sequence[str]
+        Program and arguments.
+    stdout, stderr : int | None
+        `subprocess.PIPE` to capture the stream, `subprocess.DEVNULL` to discard it, `None` to inherit it.
+    text : bool
+        Decode captured streams as text.
+    check : bool
+        Raise `subprocess.CalledProcessError` on non-zero exit code.
+    creationflags : int
+        Passed to `subprocess.Popen` (Windows only).
+    onStderrLine : typing.Callable[[str], None] | None
+        Called from a reader thread with each line written to stderr as it arrives. Implies `stderr=subprocess.PIPE`.
+    cancelEvent : threading.Event | None
+        Kill the process and raise `Cancelled` once this is set.
+    limits : Limits | None
+        Resource limits and priorities of the process. Raise `LimitExceeded` if the process is killed for exceeding one.
+    priority : int | None
+        Priority class in `scheduler`. The process is paused while processes of a more urgent class run.
+        None to leave it unscheduled.
+    '''
+    if cancelEvent is not None and cancelEvent.is_set():
+        raise Cancelled()
+    if onStderrLine is not None:
+        stderr = subprocess.PIPE
+    limits = limits or {}
+    if os.name == 'nt' and limits.get('nice', 0) > 0:
+        # IDLE_PRIORITY_CLASS, BELOW_NORMAL_PRIORITY_CLASS
+        creationflags |= 0x40 if limits['nice'] >= 10 else 0x4000
+    traceStart = tracing.now() if tracing.enabled else None
+    ts = time.perf_counter()
+    p = subprocess.Popen(command, stdout=stdout, stderr=stderr, creationflags=creationflags)
+    spawnTime = time.perf_counter() - ts
+    process = Process(p)
+    outputs: dict[str, list[bytes]] = {}
+    readers = []
+    try:
+        if os.name == 'posix' and limits:
+            applyLimits(p.pid, limits)
+        if priority is not None:
+            scheduler.register(process, priority)
+        if 'wallTime' in limits:
+            watchdog.watch(process, limits['wallTime'])
+        if cancelEvent is not None:
+            def watchCancel():
+                while not process.done.is_set():
+                    if cancelEvent.wait(.05):
+                        process.kill()
+                        return
+            threading.Thread(target=watchCancel, daemon=True).start()
+
+        for name, pipe, onLine in (('stdout', p.stdout, None), ('stderr', p.stderr, onStderrLine)):
+            if pipe is not None:
+                outputs[name] = []
+                readers.append(threading.Thread(target=readPipe, args=(pipe, outputs[name], onLine), daemon=True))
+        for t in readers:
+            t.start()
+    except BaseException:
+        # 设置失败时不能留下没有人等待的子进程
+        process.kill()
+        for t in readers:
+            if t.ident is not None:
+                t.join()
+        for pipe in (p.stdout, p.stderr):
+            if pipe is not None and not pipe.closed:
+                pipe.close()
+        process.wait()
+        if priority is not None:
+            scheduler.unregister(process)
+        raise
+    for t in readers:
+        t.join()
+
+    userTime, systemTime, peakMemory = process.wait()
+    wallTime = time.perf_counter() - ts
+    entry = scheduler.unregister(process) if priority is not None else None
+
+    for name, chunks in outputs.items():
+        outputs[name] = b''.join(chunks)
+        if text:
+            outputs[name] = outputs[name].decode().replace('\r\n', '\n').replace('\r', '\n')
+    result = RunResult(
+        returncode=p.returncode,
+        stdout=outputs.get('stdout'),
+        stderr=outputs.get('stderr'),
+        spawnTime=spawnTime,
+        wallTime=wallTime,
+        userTime=userTime,
+        systemTime=systemTime,
+        peakMemory=peakMemory,
+        pausedTime=entry.pausedSeconds() if entry is not None else 0.,
+        deprioritized=entry is not None and entry.aged,
+    )
+    if traceStart is not None:
+        tracing.complete(
+            os.path.basename(command[0]),
+            traceStart,
+            wallTime * 1e6,
+            'subprocess',
+            pid=p.pid,
+            tid=p.pid,
+            processName=os.path.basename(command[0]),
+            command=list(command),
+            returncode=result.returncode,
+            spawnTime=spawnTime,
+            userTime=userTime,
+            systemTime=systemTime,
+            peakMemory=peakMemory,
+        )
+    if process.killed and not process.timedOut and cancelEvent is not None and cancelEvent.is_set():
+        raise Cancelled()
+    if limits:
+        checkLimits(command, process, result, limits)
+    if check and result.returncode:
+        raise subprocess.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+    return result
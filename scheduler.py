@@ -0,0 +1,163 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+__all__ = [
+    'INTERACTIVE_ENCODE',
+    'INTERACTIVE_METRICS',
+    'BACKGROUND',
+    'register',
+    'unregister',
+    'waitIdle',
+]
+
+# 优先级，数值越小越优先
+INTERACTIVE_ENCODE = 0
+INTERACTIVE_METRICS = 1
+BACKGROUND = 2
+
+# 被暂停超过这个时间的进程恢复运行，只降低优先级，避免一直得不到执行
+maxPause = 3.
+# 恢复运行后增加的nice值
+agedNice = 10
+
+match (os.name):
+    case 'nt':
+        import ctypes
+        import ctypes.wintypes
+
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass.argtypes = (ctypes.wintypes.HANDLE, ctypes.wintypes.DWORD)
+        kernel32.SetPriorityClass.restype = ctypes.wintypes.BOOL
+        IDLE_PRIORITY_CLASS = 0x40
+        NORMAL_PRIORITY_CLASS = 0x20
+    case 'posix':
+        import signal
+
+class Process(typing.Protocol):
+    popen: subprocess.Popen
+    pid: int
+    lock: threading.Lock
+    reaped: bool
+
+class Entry:
+    def __init__(self, process: Process, priority: int) -> None:
+        self.process = process
+        self.priority = priority
+        self.pausedSince: float | None = None
+        self.pausedTotal = 0.
+        self.aged = False
+
+    def pausedSeconds(self) -> float:
+        return self.pausedTotal + (time.monotonic() - self.pausedSince if self.pausedSince is not None else 0.)
+
+entries: dict[int, Entry] = {}
+condition = threading.Condition()
+agingThread: threading.Thread | None = None
+
+def setPaused(entry: Entry, paused: bool):
+    '''
+    Stop or continue a process (POSIX), or drop it to the idle priority class (Windows).
+    '''
+    process = entry.process
+    with process.lock:
+        if process.reaped:
+            return
+        try:
+            if os.name == 'posix':
+                os.kill(process.pid, signal.SIGSTOP if paused else signal.SIGCONT)
+            else:
+                kernel32.SetPriorityClass(int(process.popen._handle), IDLE_PRIORITY_CLASS if paused else NORMAL_PRIORITY_CLASS)
+        except ProcessLookupError:
+            return
+    if paused:
+        entry.pausedSince = time.monotonic()
+    elif entry.pausedSince is not None:
+        entry.pausedTotal += time.monotonic() - entry.pausedSince
+        entry.pausedSince = None
+
+def renice(entry: Entry):
+    process = entry.process
+    with process.lock:
+        if process.reaped:
+            return
+        try:
+            if os.name == 'nt':
+                kernel32.SetPriorityClass(int(process.popen._handle), IDLE_PRIORITY_CLASS)
+            elif sys.platform == 'linux':
+                # Linux下nice值是每个线程的，需要修改所有线程
+                for tid in os.listdir(f'/proc/{process.pid}/task'):
+                    os.setpriority(os.PRIO_PROCESS, int(tid), min(os.getpriority(os.PRIO_PROCESS, int(tid)) + agedNice, 19))
+            else:
+                os.setpriority(os.PRIO_PROCESS, process.pid, min(os.getpriority(os.PRIO_PROCESS, process.pid) + agedNice, 19))
+        except (ProcessLookupError, FileNotFoundError, PermissionError):
+            pass
+
+def update():
+    '''
+    Pause every process that has a running process of a more urgent class, and continue the others.
+    Must be called with condition held.
+    '''
+    highest = min((e.priority for e in entries.values() if not e.aged), default=None)
+    for entry in entries.values():
+        if entry.aged:
+            continue
+        shouldPause = highest is not None and entry.priority > highest
+        if shouldPause != (entry.pausedSince is not None):
+            setPaused(entry, shouldPause)
+    condition.notify_all()
+
+def age():
+    with condition:
+        while True:
+            paused = [e for e in entries.values() if e.pausedSince is not None]
+            if not paused:
+                condition.wait()
+                continue
+            now = time.monotonic()
+            for entry in paused:
+                if now - entry.pausedSince >= maxPause:
+                    # 等待太久的进程恢复运行，之后不再暂停，但降低优先级
+                    setPaused(entry, False)
+                    entry.aged = True
+                    renice(entry)
+            condition.wait(min((maxPause - (now - e.pausedSince) for e in paused if e.pausedSince is not None), default=maxPause) + .01)
+
+def register(process: Process, priority: int):
+    '''
+    Start scheduling a running process in a priority class.
+    '''
+    global agingThread
+    with condition:
+        entries[process.pid] = Entry(process, priority)
+        if agingThread is None:
+            agingThread = threading.Thread(target=age, name='scheduler', daemon=True)
+            agingThread.start()
+        update()
+
+def unregister(process: Process) -> Entry | None:
+    '''
+    Stop scheduling a process that has exited, and return its entry with the seconds it spent paused.
+    '''
+    with condition:
+        if (entry := entries.pop(process.pid, None)) is not None:
+            update()
+        return entry
+
+def pausedSeconds(process: Process) -> float:
+    with condition:
+        return entries[process.pid].pausedSeconds() if process.pid in entries else 0.
+
+def waitIdle(priority: int, timeout: float = maxPause) -> bool:
+    '''
+    Defer work of a priority class while processes of a more urgent class are running,
+    for at most timeout seconds so that it cannot starve. Returns False on timeout.
+    '''
+    with condition:
+        return condition.wait_for(
+            lambda: all(e.priority >= priority or e.aged for e in entries.values()),
+            timeout,
+        )
@@ -0,0 +1,156 @@
+import bisect
+import contextlib
+import threading
+import time
+import tracing
+import typing
+
+__all__ = [
+    'Histogram',
+    'settingsLabel',
+    'observe',
+    'count',
+    'timer',
+    'snapshot',
+    'prometheus',
+]
+
+# 1ms ~ 262s
+SECONDS_BOUNDS = tuple(0.001 * 2 ** i for i in range(19))
+# 1KiB ~ 256MiB
+BYTES_BOUNDS = tuple(1024 * 4 ** i for i in range(10))
+
+class Histogram:
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        r = []
+        c = 0
+        for le, n in zip((*self.bounds, float('inf')), self.buckets):
+            c += n
+            r.append((le, c))
+        return r
+
+    def toDict(self) -> dict[str, typing.Any]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'mean': self.sum / self.count if self.count else None,
+            'buckets': [(le if le != float('inf') else '+Inf', c) for le, c in self.cumulative()],
+        }
+
+Labels = tuple[tuple[str, str], ...]
+
+families: dict[str, tuple[str, str, tuple[float, ...] | None]] = {
+    'stage_seconds': ('histogram', 'Time spent in each stage of an API call', SECONDS_BOUNDS),
+    'bytes': ('histogram', 'Size of the data passed to and returned from an encoder', BYTES_BOUNDS),
+    'requests_total': ('counter', 'Number of msgpack API calls', None),
+    'encodes_total': ('counter', 'Number of encoder runs', None),
+    'limits_exceeded_total': ('counter', 'Number of child processes killed or failed for exceeding a resource limit', None),
+}
+histograms: dict[tuple[str, Labels], Histogram] = {}
+counters: dict[tuple[str, Labels], float] = {}
+lock = threading.Lock()
+
+def settingsLabel(options: dict[str, typing.Any]) -> str:
+    '''
+    Build a stable label value from encoder options.
+
+    Parameters
+    ----------
+    options : dict[str, typing.Any]
+        Encoder options, as in `EncoderState['options']`.
+    '''
+    return ','.join(f'{k}={v}' for k, v in sorted(options.items()))
+
+def observe(name: str, value: float, **labels: str):
+    '''
+    Record a value into the histogram identified by family name and labels.
+    '''
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with lock:
+        if (h := histograms.get(key)) is None:
+            h = histograms[key] = Histogram(families[name][2])
+        h.observe(value)
+
+def count(name: str, value: float = 1, **labels: str):
+    '''
+    Increase the counter identified by family name and labels.
+    '''
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+@contextlib.contextmanager
+def timer(stage: str, **labels: str):
+    '''
+    Measure the wall time of the enclosed block as `stage_seconds{stage=...}`.
+    The block is also recorded as a trace span when tracing is enabled.
+    '''
+    ts = time.perf_counter()
+    try:
+        with tracing.span(stage, **labels):
+            yield
+    finally:
+        observe('stage_seconds', time.perf_counter() - ts, stage=stage, **labels)
+
+def snapshot() -> dict[str, list[dict[str, typing.Any]]]:
+    with lock:
+        return {
+            'histograms': [
+                {'name': name, 'labels': dict(labels), **h.toDict()}
+                for (name, labels), h in sorted(histograms.items())
+            ],
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': v}
+                for (name, labels), v in sorted(counters.items())
+            ],
+        }
+
+def prometheus(prefix: str = 'squoosh_') -> str:
+    '''
+    Render all series in Prometheus text exposition format (version 0.0.4).
+    '''
+    def formatLabels(labels: Labels, *extra: tuple[str, str]) -> str:
+        labels = (*labels, *extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            k + '="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for k, v in labels
+        ) + '}'
+
+    lines = []
+    with lock:
+        for family, (kind, description, _) in families.items():
+            lines.append(f'# HELP {prefix}{family} {description}')
+            lines.append(f'# TYPE {prefix}{family} {kind}')
+            if kind == 'histogram':
+                for (name, labels), h in sorted(histograms.items()):
+                    if name != family:
+                        continue
+                    for le, c in h.cumulative():
+                        le = '+Inf' if le == float('inf') else repr(le)
+                        lines.append(f'{prefix}{name}_bucket{formatLabels(labels, ("le", le))} {c}')
+                    lines.append(f'{prefix}{name}_sum{formatLabels(labels)} {h.sum!r}')
+                    lines.append(f'{prefix}{name}_count{formatLabels(labels)} {h.count}')
+            else:
+                for (name, labels), v in sorted(counters.items()):
+                    if name == family:
+                        lines.append(f'{prefix}{name}{formatLabels(labels)} {v!r}')
+    return '\n'.join(lines) + '\n'
@@ -3,6 +3,7 @@ import ctypes
 import wvruntime
 
 __all__ = [
+    'bufferPointer',
     'write',
 ]
 
@@ -15,10 +16,21 @@ match (os.name):
         raise NotImplementedError(f'libsvpng is not supported on os.name = {os.name}')
 
 libsvpng = ctypes.cdll.LoadLibrary(os.path.join(wvruntime.contentPath, f'libsvpng{dllext}'))
-libsvpng.svpng_file.argtypes = (ctypes.c_char_p, ctypes.c_uint, ctypes.c_uint, ctypes.c_char_p, ctypes.c_int)
+libsvpng.svpng_file.argtypes = (ctypes.c_char_p, ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p, ctypes.c_int)
 libsvpng.svpng_file.restype = None
 
-def write(file: str, w: int, h: int, img: bytes, alpha: bool):
+def bufferPointer(data: bytes | bytearray | memoryview) -> bytes | ctypes.Array:
+    '''
+    Something that can be passed as a c_void_p argument pointing to the data.
+    bytes and writable buffers (such as shared memory) are not copied.
+    '''
+    if isinstance(data, bytes):
+        return data
+    data = memoryview(data)
+    # 只读的buffer无法直接取得指针，只能复制
+    return (ctypes.c_char * data.nbytes).from_buffer(data.cast('B')) if not data.readonly else bytes(data)
+
+def write(file: str, w: int, h: int, img: bytes | bytearray | memoryview, alpha: bool):
     '''
     Save a RGB/RGBA image in PNG format.
 
@@ -30,10 +42,14 @@ def write(file: str, w: int, h: int, img: bytes, alpha: bool):
         Width of the image.
     h : int
         Height of the image.
-    img : bytes
+    img : bytes | bytearray | memoryview
         Image pixel data in 24-bit RGB or 32-bit RGBA format.
+        bytes and writable buffers (such as shared memory) are passed to libsvpng without copying.
     alpha : bool
         Whether the image contains alpha channel.
     '''
-    libsvpng.svpng_file(ctypes.create_string_buffer(file.encode()), w, h, ctypes.create_string_buffer(img), alpha)
-
+    size = w * h * (4 if alpha else 3)
+    buffer = bufferPointer(img)
+    if len(buffer) < size:
+        raise ValueError(f'Image data too short: {len(buffer)} < {size}')
+    libsvpng.svpng_file(file.encode(), w, h, buffer, alpha)
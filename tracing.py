@@ -0,0 +1,96 @@
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+import typing
+
+__all__ = [
+    'enabled',
+    'now',
+    'span',
+    'complete',
+    'dump',
+]
+
+# 设置环境变量TRACE为输出文件的路径以启用，退出时写入Chrome trace event格式的JSON
+# 可以在chrome://tracing或https://ui.perfetto.dev中打开
+outputFile = os.environ.get('TRACE')
+enabled = bool(outputFile)
+
+# perf_counter精度更高，但需要和JS侧的performance.timeOrigin + performance.now()对齐到Unix时间
+epochOffset = time.time_ns() - time.perf_counter_ns()
+events: list[dict[str, typing.Any]] = []
+namedThreads: set[int] = set()
+namedProcesses: set[int] = set()
+
+def now() -> float:
+    '''
+    Current time in microseconds since the Unix epoch.
+    '''
+    return (time.perf_counter_ns() + epochOffset) / 1000
+
+def nameThread(tid: int):
+    if tid not in namedThreads:
+        namedThreads.add(tid)
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': threading.current_thread().name}})
+
+def complete(name: str, ts: float, dur: float, cat: str = 'backend', pid: int | None = None, tid: int | None = None, processName: str | None = None, **args):
+    '''
+    Record a complete ("X") event.
+
+    Parameters
+    ----------
+    name : str
+        Event name.
+    ts : float
+        Start time in microseconds since the Unix epoch.
+    dur : float
+        Duration in microseconds.
+    cat : str
+        Event category.
+    pid, tid : int | None
+        Process and thread lane, defaults to the current ones.
+    processName : str | None
+        Label for the process lane, useful for child processes and the frontend.
+    '''
+    if not enabled:
+        return
+    if pid is None:
+        pid = os.getpid()
+    if tid is None:
+        tid = threading.get_ident()
+        nameThread(tid)
+    if processName is not None and pid not in namedProcesses:
+        namedProcesses.add(pid)
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': processName}})
+    events.append({'name': name, 'cat': cat, 'ph': 'X', 'ts': ts, 'dur': dur, 'pid': pid, 'tid': tid, 'args': args})
+
+class Span:
+    def __init__(self, name: str, cat: str, args: dict[str, typing.Any]) -> None:
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self) -> 'Span':
+        self.ts = now()
+        return self
+
+    def __exit__(self, *exc):
+        complete(self.name, self.ts, now() - self.ts, self.cat, **self.args)
+
+nullSpan = contextlib.nullcontext()
+
+def span(name: str, cat: str = 'backend', **args) -> typing.ContextManager:
+    '''
+    Record the enclosed block as a complete event. Returns a shared no-op context manager when tracing is disabled.
+    '''
+    return Span(name, cat, args) if enabled else nullSpan
+
+def dump(file: str):
+    with open(file, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+if enabled:
+    atexit.register(dump, outputFile)
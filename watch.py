@@ -0,0 +1,373 @@
+import argparse
+import ctypes
+import ctypes.util
+import heapq
+import json
+import os
+import select
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import typing
+
+import image_cli
+import pipeline
+import runner
+import scheduler
+
+# 会被加入队列的源文件扩展名
+sourceExtensions = ('.png', '.jpg', '.jpeg', '.webp')
+outputExtensions = {
+    'avif': '.avif',
+    'jpeg': '.jpg',
+    'jxl': '.jxl',
+    'png': '.png',
+    'webp': '.webp',
+}
+
+def fileStat(file: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+class Watcher:
+    '''
+    Reports files created, modified or moved into the watched directories.
+    '''
+    def __init__(self, roots: list[str], recursive: bool) -> None:
+        self.roots = roots
+        self.recursive = recursive
+
+    def walk(self) -> typing.Iterator[str]:
+        for root in self.roots:
+            if not self.recursive:
+                yield from (e.path for e in os.scandir(root) if e.is_file())
+                continue
+            for dirpath, _, filenames in os.walk(root):
+                yield from (os.path.join(dirpath, x) for x in filenames)
+
+    def poll(self, timeout: float) -> list[str]:
+        '''
+        Wait up to timeout seconds and return the paths of changed files.
+        '''
+        raise NotImplementedError()
+
+class PollingWatcher(Watcher):
+    def __init__(self, roots: list[str], recursive: bool, interval: float) -> None:
+        super().__init__(roots, recursive)
+        self.interval = interval
+        self.stats = {x: fileStat(x) for x in self.walk()}
+        self.lastScan = time.monotonic()
+
+    def poll(self, timeout: float) -> list[str]:
+        time.sleep(max(min(timeout, self.lastScan + self.interval - time.monotonic()), 0))
+        if time.monotonic() < self.lastScan + self.interval:
+            return []
+        self.lastScan = time.monotonic()
+        stats = {x: fileStat(x) for x in self.walk()}
+        changed = [x for x, st in stats.items() if st is not None and self.stats.get(x) != st]
+        self.stats = stats
+        return changed
+
+class InotifyWatcher(Watcher):
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, roots: list[str], recursive: bool) -> None:
+        super().__init__(roots, recursive)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc.inotify_init1.argtypes = (ctypes.c_int,)
+        self.libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches: dict[int, str] = {}
+        for root in roots:
+            self.addTree(root)
+
+    def addWatch(self, directory: str):
+        wd = self.libc.inotify_add_watch(
+            self.fd,
+            os.fsencode(directory),
+            self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE,
+        )
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), directory)
+        self.watches[wd] = directory
+
+    def addTree(self, directory: str) -> list[str]:
+        '''
+        Watch a directory (and its subdirectories if recursive), returning the files already in it.
+        '''
+        self.addWatch(directory)
+        if not self.recursive:
+            return []
+        files = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for x in dirnames:
+                self.addWatch(os.path.join(dirpath, x))
+            files.extend(os.path.join(dirpath, x) for x in filenames)
+        return files
+
+    def poll(self, timeout: float) -> list[str]:
+        if not select.select((self.fd,), (), (), timeout)[0]:
+            return []
+        buffer = os.read(self.fd, 65536)
+        changed = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = struct.unpack_from('iIII', buffer, offset)
+            name = os.fsdecode(buffer[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                # 丢失了事件，只能重新扫描全部文件
+                changed.extend(self.walk())
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+            path = os.path.join(self.watches[wd], name)
+            if mask & self.IN_ISDIR:
+                if self.recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # 新目录中可能在添加监视之前就已经有文件了
+                    changed.extend(self.addTree(path))
+                continue
+            changed.append(path)
+        return changed
+
+class Queue:
+    '''
+    Priority queue of files to encode, smallest first so that the queue drains predictably.
+    '''
+    def __init__(self) -> None:
+        self.heap: list[tuple[int, int, str]] = []
+        self.queued: set[str] = set()
+        self.counter = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, file: str, size: int):
+        with self.condition:
+            if file in self.queued:
+                return
+            self.queued.add(file)
+            self.counter += 1
+            heapq.heappush(self.heap, (size, self.counter, file))
+            self.condition.notify()
+
+    def get(self) -> str | None:
+        with self.condition:
+            while not self.heap and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            file = heapq.heappop(self.heap)[2]
+            self.queued.discard(file)
+            return file
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class Daemon:
+    def __init__(self, args: argparse.Namespace, stages: list[image_cli.EncoderStage]) -> None:
+        self.roots = [os.path.abspath(x) for x in args.dirs]
+        self.outputDir = os.path.abspath(args.output_dir) if args.output_dir else None
+        self.suffix = args.suffix if args.suffix is not None else ('' if self.outputDir else '.min')
+        self.stages = stages
+        self.inputFormats = image_cli.encoderOptionsClassMapping[stages[0]['type']].inputFormats
+        self.outputExtension = outputExtensions[image_cli.encoderOptionsClassMapping[stages[-1]['type']].outputFormat]
+        self.debounce = args.debounce
+        self.queue = Queue()
+        # path -> (time of the last change, stat at that time)
+        self.pending: dict[str, tuple[float, tuple[int, int] | None]] = {}
+        # 自己写入的输出文件，忽略它们的变化
+        self.outputs: dict[str, tuple[int, int] | None] = {}
+        self.outputsLock = threading.Lock()
+        if os.name == 'posix' and not args.poll:
+            try:
+                self.watcher = InotifyWatcher(self.roots, args.recursive)
+            except (OSError, AttributeError, TypeError) as ex:
+                print(f'inotify unavailable ({ex}), falling back to polling', file=sys.stderr)
+                self.watcher = PollingWatcher(self.roots, args.recursive, args.interval)
+        else:
+            self.watcher = PollingWatcher(self.roots, args.recursive, args.interval)
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(args.workers)]
+
+    def root(self, file: str) -> str:
+        return max((x for x in self.roots if file.startswith(x + os.sep)), key=len)
+
+    def outputPath(self, file: str) -> str:
+        root = self.root(file)
+        stem = os.path.splitext(os.path.relpath(file, root))[0]
+        return os.path.join(self.outputDir or root, stem + self.suffix + self.outputExtension)
+
+    def isSource(self, file: str) -> bool:
+        name = os.path.basename(file)
+        if name.startswith('.') or not name.lower().endswith(sourceExtensions):
+            return False
+        if self.outputDir is not None and file.startswith(self.outputDir + os.sep):
+            return False
+        if self.suffix and os.path.splitext(name)[0].endswith(self.suffix):
+            return False
+        with self.outputsLock:
+            return file not in self.outputs or self.outputs[file] != fileStat(file)
+
+    def upToDate(self, file: str) -> bool:
+        source = fileStat(file)
+        output = fileStat(self.outputPath(file))
+        return source is not None and output is not None and output[1] >= source[1]
+
+    def enqueue(self, file: str):
+        if (st := fileStat(file)) is not None:
+            self.queue.put(file, st[0])
+
+    def encode(self, file: str):
+        probe = image_cli.probeImage(file)
+        if probe is None or probe[0] not in self.inputFormats:
+            print(f'Skipped {file}: {self.stages[0]['type']} cannot read {probe[0] if probe else 'this format'}', file=sys.stderr)
+            return
+        ts = time.perf_counter()
+        # 只从原文件编码，像素数据不会被使用
+        r = pipeline.encode({'width': probe[1], 'height': probe[2], 'data': b''}, self.stages, sourceFile=file, priority=scheduler.BACKGROUND)
+        output = self.outputPath(file)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        # 先写入同一目录下的临时文件再替换，其他程序不会读到写了一半的文件
+        fd, temp = tempfile.mkstemp(self.outputExtension + '.tmp', '.', os.path.dirname(output))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(r.data)
+            with self.outputsLock:
+                os.replace(temp, output)
+                self.outputs[output] = fileStat(output)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        print(
+            os.path.relpath(file, self.root(file)),
+            f'{os.path.getsize(file)}B -> {len(r.data)}B',
+            f'{(time.perf_counter() - ts) * 1000:.0f}ms',
+            sep='\t',
+        )
+
+    def work(self):
+        while (file := self.queue.get()) is not None:
+            try:
+                self.encode(file)
+            except runner.Cancelled:
+                return
+            except runner.LimitExceeded as ex:
+                print(f'Gave up {file}: {ex}', file=sys.stderr)
+            except Exception:
+                print(f'Failed to encode {file}', file=sys.stderr)
+                traceback.print_exc()
+
+    def run(self, initial: bool):
+        if initial:
+            for file in self.watcher.walk():
+                if self.isSource(file) and not self.upToDate(file):
+                    self.enqueue(file)
+        for t in self.workers:
+            t.start()
+        while True:
+            now = time.monotonic()
+            # 文件在debounce秒内没有变化才认为已经写完
+            for file, (t, st) in tuple(self.pending.items()):
+                if now - t < self.debounce:
+                    continue
+                if (current := fileStat(file)) != st:
+                    self.pending[file] = (now, current)
+                    continue
+                del self.pending[file]
+                if current is not None:
+                    self.enqueue(file)
+            timeout = min((t + self.debounce - now for t, _ in self.pending.values()), default=1.)
+            for file in self.watcher.poll(max(timeout, .05)):
+                if self.isSource(file):
+                    self.pending[file] = (time.monotonic(), fileStat(file))
+
+    def close(self):
+        self.queue.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch folders and encode new or changed images with the native encoders in the bin folder.')
+    parser.add_argument('dirs', nargs='+', help='directories to watch')
+    parser.add_argument('-e', '--encoder', choices=tuple(image_cli.encoderOptionsClassMapping), help='encoder to use with its default options')
+    parser.add_argument('-p', '--preset', help='JSON file with an EncoderState ({"type": ..., "options": ..., "pipeline": [...]}), options default to the Squoosh defaults')
+    parser.add_argument('-o', '--output-dir', help='write outputs into a mirror tree under this directory instead of next to the sources')
+    parser.add_argument('-s', '--suffix', help='appended to the output file name before the extension (default: ".min", or "" with --output-dir)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='watch subdirectories too')
+    parser.add_argument('-j', '--workers', type=int, default=2, help='files encoded at the same time (default: %(default)s)')
+    parser.add_argument('--debounce', type=float, default=1., help='seconds a file must stay unchanged before it is encoded (default: %(default)s)')
+    parser.add_argument('--poll', action='store_true', help='poll instead of using inotify')
+    parser.add_argument('--interval', type=float, default=2., help='polling interval in seconds (default: %(default)s)')
+    parser.add_argument('--no-initial', action='store_true', help='do not encode existing files whose output is missing or older')
+    parser.add_argument('--timeout', type=float, help='kill encodes running longer than this many seconds (default: 600)')
+    parser.add_argument('--cpu-time', type=float, help='CPU time limit of each encoder in seconds')
+    parser.add_argument('--memory-limit', type=int, help='address space limit of each encoder in MiB')
+    parser.add_argument('--nice', type=int, default=10, help='niceness added to the encoders (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.preset:
+        with open(args.preset, 'r', encoding='utf-8') as f:
+            state: image_cli.EncoderState = json.load(f)
+    elif args.encoder:
+        state = {'type': args.encoder, 'options': {}}
+    else:
+        parser.error('either --encoder or --preset is required')
+    stages = [
+        {
+            'type': x['type'],
+            'options': {**image_cli.encoderOptionsClassMapping[x['type']].defaultOptions, **x.get('options', {})},
+            'limits': x.get('limits', {}),
+        }
+        if x['type'] in image_cli.encoderOptionsClassMapping else x
+        for x in (state, *state.get('pipeline', ()))
+    ]
+    limits: runner.Limits = {'nice': args.nice, 'ioPriority': -1 if args.nice >= 10 else 4}
+    if args.timeout is not None:
+        limits['wallTime'] = args.timeout
+    if args.cpu_time is not None:
+        limits['cpuTime'] = args.cpu_time
+    if args.memory_limit is not None:
+        limits['addressSpace'] = args.memory_limit * 1048576
+    for x in stages:
+        x['limits'] = {**limits, **x.get('limits', {})}
+    try:
+        pipeline.validate(stages)
+    except RuntimeError as ex:
+        parser.error(str(ex))
+    codecs = image_cli.checkCodec()
+    for x in stages:
+        if not codecs.get(x['type']):
+            parser.error(f'{x['type']} is not available in {image_cli.binDir}')
+    for x in args.dirs:
+        if not os.path.isdir(x):
+            parser.error(f'Not a directory: {x}')
+
+    if args.suffix == '' and not args.output_dir:
+        parser.error('outputs would overwrite the sources, use --suffix or --output-dir')
+
+    daemon = Daemon(args, stages)
+    try:
+        daemon.run(not args.no_initial)
+    except KeyboardInterrupt:
+        daemon.close()
+
+if __name__ == '__main__':
+    main()
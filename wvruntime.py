@@ -1,5 +1,6 @@
 import base64
 import bottle
+import contextlib
 import datetime
 import hashlib
 import json
@@ -19,6 +20,8 @@ __all__ = [
     'mount',
     'exposeDnDHook',
     'initMsgpackApi',
+    'MsgpackApiHooks',
+    'dispatchEvent',
     'WVResourceLocal',
     'WVResourceZip',
     'WVResourceObfuscatedZip',
@@ -104,6 +107,28 @@ class WVResourceObfuscatedZip(WVResourceZip):
 mountmap: dict[str, list[WVResource]] = {}
 msgpackApimap: dict[str, typing.Callable] = {}
 
+class MsgpackApiHooks:
+    '''
+    msgpack API调用的各个阶段的回调，可以用于统计和追踪
+    替换模块的msgpackApiHooks来使用
+    '''
+    def request(self, fn: str) -> typing.ContextManager:
+        '''
+        包装整个请求
+        '''
+        return contextlib.nullcontext()
+
+    def phase(self, fn: str, phase: str) -> typing.ContextManager:
+        '''
+        包装请求的各个阶段：msgpack_decode, call, msgpack_encode
+        '''
+        return contextlib.nullcontext()
+
+    def finished(self, fn: str, success: bool):
+        pass
+
+msgpackApiHooks = MsgpackApiHooks()
+
 def mount(mountpoint: str, resource: WVResource):
     '''
     在内置HTTP Server的指定URL前缀下挂载资源包
@@ -130,10 +155,22 @@ def _(fn: str):
         return bottle.HTTPError(404)
     if bottle.request.headers['Content-Type'] != 'application/msgpack':
         return bottle.HTTPError(400)
+    with msgpackApiHooks.request(fn):
+        return callMsgpackApi(fn, func)
+
+def callMsgpackApi(fn: str, func: typing.Callable) -> bottle.HTTPResponse:
     try:
-        return bottle.HTTPResponse(msgpack.dumps((True, func(*msgpack.load(bottle.request.body)))), headers={'Content-Type': 'application/msgpack'})
+        with msgpackApiHooks.phase(fn, 'msgpack_decode'):
+            args = msgpack.load(bottle.request.body)
+        with msgpackApiHooks.phase(fn, 'call'):
+            result = func(*args)
+        with msgpackApiHooks.phase(fn, 'msgpack_encode'):
+            body = msgpack.dumps((True, result))
+        msgpackApiHooks.finished(fn, True)
+        return bottle.HTTPResponse(body, headers={'Content-Type': 'application/msgpack'})
     except Exception as ex:
         traceback.print_exc()
+        msgpackApiHooks.finished(fn, False)
         return bottle.HTTPResponse(msgpack.dumps((False, [type(ex).__name__, str(ex)])), headers={'Content-Type': 'application/msgpack'})
 
 @app.get('/')
@@ -240,6 +277,21 @@ def initMsgpackApi(window: webview.Window):
                 })
     ''')
 
+def dispatchEvent(window: webview.Window, name: str, detail: typing.Any = None):
+    '''
+    在JS环境的window上触发CustomEvent，用于从Python环境主动推送数据
+
+    Parameters
+    ----------
+    window : webview.Window
+        触发事件的窗口
+    name : str
+        事件名称
+    detail : typing.Any
+        CustomEvent的detail，需要可以序列化为JSON
+    '''
+    window.evaluate_js(f'window.dispatchEvent(new CustomEvent({json.dumps(name)}, {{ detail: {json.dumps(detail)} }}))')
+
 def exposeDnDHook(window: webview.Window):
     '''
     添加拖拽相关支持